@@ -0,0 +1,257 @@
+"""
+Benchmark threadWatchChanges and threadApplyChanges against an in-process fake api server
+
+Generates a synthetic cluster, starts the controller components like run.py does,
+changes a burst of configmaps/secrets and waits for all resulting patches.
+
+    python -m benchmark.bench --workloads 10000 --pods 50000 --changes 500
+"""
+from __future__ import print_function
+import logging, argparse, random, resource, time, sys, json, os, threading
+from Queue import Queue
+from kubernetes import client
+from benchmark import fakeapi
+from custom_libs import watchchanges, applychanges, workloadcache, podcache, digests, metadata, apiclient
+
+KINDS = [('deployments', 6), ('daemonsets', 2), ('replicationcontrollers', 2)]
+
+def build_cluster(store, namespaces, workloads, pods, configs, data_size=0, content=False):
+    """
+    Create configs, controllers with our signature and their running pods
+
+    Every controller uses one configmap as a volume and one secret as an env value,
+    and already has the annotations with the current versions.
+    data_size bytes of unused data are added to every config.
+    With content the annotations have the digests instead of the resourceVersions
+    """
+
+    extra = {'unused': 'x' * data_size} if data_size else {}
+    kinds = [plural for (plural, weight) in KINDS for i in range(weight)]
+    versions = {}
+    for n in range(namespaces):
+        namespace = 'ns-%s' % n
+        for c in range(configs):
+            cm = store.create('configmaps', {'metadata': {'namespace': namespace, 'name': 'cm-%s' % c}, 'data': dict(extra, key='v0')})
+            versions[(namespace, 'ConfigMap', 'cm-%s' % c)] = get_version(cm, None, content)
+            secret = store.create('secrets', {'metadata': {'namespace': namespace, 'name': 'secret-%s' % c}, 'data': dict(extra, key='djA=')})
+            versions[(namespace, 'Secret', 'secret-%s' % c)] = get_version(secret, ['key'], content)
+
+    pods_per_workload = max(pods / max(workloads, 1), 1)
+    for w in range(workloads):
+        namespace = 'ns-%s' % (w % namespaces)
+        name = 'app-%s' % w
+        plural = kinds[w % len(kinds)]
+        cm = 'cm-%s' % random.randrange(configs)
+        secret = 'secret-%s' % random.randrange(configs)
+        annotations = {
+                'opsguru.signature/ConfigMap.' + cm: versions[(namespace, 'ConfigMap', cm)],
+                'opsguru.signature/Secret.' + secret: versions[(namespace, 'Secret', secret)],
+                }
+        template = {
+                'metadata': {'labels': {'app': name}, 'annotations': annotations},
+                'spec': {
+                    'containers': [{'name': 'app', 'image': 'app',
+                                    'env': [{'name': 'KEY', 'valueFrom': {'secretKeyRef': {'name': secret, 'key': 'key'}}}]}],
+                    'volumes': [{'name': 'config', 'configMap': {'name': cm}}],
+                    },
+                }
+        obj = {
+                'metadata': {'namespace': namespace, 'name': name, 'annotations': {'opsguru.signature/should_update': 'True'}},
+                'spec': {'replicas': pods_per_workload, 'selector': {'app': name}, 'template': template},
+                'status': get_status(plural, pods_per_workload),
+                }
+        res = store.create(plural, obj)
+        owner = {'kind': res['kind'], 'name': name}
+        if plural == 'deployments':
+            rs = store.create('replicasets', {
+                    'metadata': {'namespace': namespace, 'name': name + '-rs', 'ownerReferences': [dict(owner, apiVersion='extensions/v1beta1', uid=name)]},
+                    'spec': {'replicas': pods_per_workload},
+                    'status': {'replicas': pods_per_workload},
+                    })
+            owner = {'kind': 'ReplicaSet', 'name': rs['metadata']['name']}
+        for p in range(pods_per_workload):
+            store.create('pods', {
+                    'metadata': {'namespace': namespace, 'name': '%s-%s' % (owner['name'], p),
+                                 'ownerReferences': [dict(owner, apiVersion='v1', uid=owner['name'])]},
+                    'spec': {'containers': [{'name': 'app', 'image': 'app'}]},
+                    'status': {'phase': 'Running'},
+                    })
+
+def get_version(obj, keys, content):
+    """
+    Version of the config like threadWatchChanges computes it
+    """
+
+    if content:
+        return digests.compute_digest(client.V1ConfigMap(data=obj['data']), keys)
+    return obj['metadata']['resourceVersion']
+
+def get_status(plural, replicas):
+    """
+    Status of a controller that finished rolling out
+    """
+
+    if plural == 'daemonsets':
+        return {'observedGeneration': 1, 'currentNumberScheduled': replicas, 'desiredNumberScheduled': replicas,
+                'numberMisscheduled': 0, 'numberReady': replicas, 'updatedNumberScheduled': replicas, 'numberAvailable': replicas}
+    return {'observedGeneration': 1, 'replicas': replicas, 'updatedReplicas': replicas, 'readyReplicas': replicas,
+            'availableReplicas': replicas}
+
+def get_expected(store, changed):
+    """
+    Return the set of (namespace, name) of controllers using the changed configs
+    """
+
+    expected = set()
+    for plural in ('deployments', 'daemonsets', 'replicationcontrollers'):
+        for ((namespace, name), obj) in store.objects[plural].items():
+            for key_ann in obj['spec']['template']['metadata']['annotations']:
+                (kind, cfg_name) = key_ann.split('/', 1)[1].split('.', 1)
+                if (namespace, kind, cfg_name) in changed:
+                    expected.add((namespace, name))
+    return expected
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+def get_rss_mb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark against a fake kubernetes api server')
+    parser.add_argument('--namespaces', type=int, default=50)
+    parser.add_argument('--workloads', type=int, default=1000)
+    parser.add_argument('--pods', type=int, default=5000)
+    parser.add_argument('--configs', type=int, default=10, help='configmaps and secrets per namespace')
+    parser.add_argument('--changes', type=int, default=100, help='configs changed in the burst')
+    parser.add_argument('--repeat', type=int, default=1, help='how many times every config is changed in the burst')
+    parser.add_argument('--timer-timeout', type=float, default=0, help='debounce of threadApplyChanges')
+    parser.add_argument('--min-debounce', type=float, default=None, help='shortest debounce, default --timer-timeout')
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--pool-size', type=int, default=50, help='connections to the api server')
+    parser.add_argument('--page-size', type=int, default=500, help='objects per list page, 0 for no pages')
+    parser.add_argument('--no-gzip', action='store_true', help="don't ask for compressed responses")
+    parser.add_argument('--metadata-only', action='store_true', help='watch only the metadata of configmaps/secrets')
+    parser.add_argument('--content', action='store_true', help='use content digests as versions')
+    parser.add_argument('--data-size', type=int, default=0, help='bytes of extra data in every configmap/secret')
+    parser.add_argument('--deadline', type=float, default=300, help='seconds to wait for all patches')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(args.seed)
+
+    store = fakeapi.FakeApiStore()
+    server = fakeapi.FakeApiServer(store)
+    configuration = client.Configuration()
+    configuration.host = server.start()
+    client.Configuration.set_default(configuration)
+    apiclient.setup(args.pool_size, not args.no_gzip, args.page_size)
+
+    start = time.time()
+    build_cluster(store, args.namespaces, args.workloads, args.pods, args.configs, args.data_size, args.content)
+    report = {'build_seconds': time.time() - start, 'rss_after_build_mb': get_rss_mb()}
+
+    start = time.time()
+    q = Queue()
+    cache = workloadcache.WorkloadCache()
+    cache.start()
+    cache.wait_for_sync()
+    pod_cache = podcache.PodCache()
+    pod_cache.start()
+    pod_cache.wait_for_sync()
+    v1 = client.CoreV1Api(apiclient.get_api_client())
+    digest_cache = digests.DigestCache() if args.content else None
+    if args.metadata_only:
+        funcs = [(metadata.MetadataLister('ConfigMap'), v1.read_namespaced_config_map),
+                 (metadata.MetadataLister('Secret'), v1.read_namespaced_secret)]
+    else:
+        funcs = [(v1.list_config_map_for_all_namespaces, None), (v1.list_secret_for_all_namespaces, None)]
+    watchers = [
+            watchchanges.threadWatchChanges("configmaps", q, funcs[0][0], 'ConfigMap', cache, args.workers,
+                                            digests=digest_cache, read_func=funcs[0][1]),
+            watchchanges.threadWatchChanges("secrets", q, funcs[1][0], 'Secret', cache, args.workers,
+                                            digests=digest_cache, read_func=funcs[1][1]),
+            ]
+    for watcher in watchers:
+        watcher.daemon = True
+        watcher.start()
+    for watcher in watchers:
+        watcher.synced.wait()
+    worker = applychanges.threadApplyChanges("worker", q, cache, pod_cache, args.timer_timeout, patch_workers=args.workers,
+                                         min_debounce=args.min_debounce)
+    worker.daemon = True
+    worker.start()
+    report['sync_seconds'] = time.time() - start
+    report['rss_after_sync_mb'] = get_rss_mb()
+    report['threads'] = threading.active_count()
+
+    # let the initial events settle, nothing should be patched
+    time.sleep(2)
+    report['patches_at_start'] = len(store.patches)
+
+    all_configs = [(namespace, kind, name) for (plural, kind) in (('configmaps', 'ConfigMap'), ('secrets', 'Secret'))
+                   for (namespace, name) in store.objects[plural]]
+    changed = random.sample(all_configs, min(args.changes, len(all_configs)))
+    expected = get_expected(store, set(changed))
+    calls_before = sum(count for ((verb, plural), count) in store.calls.items() if verb != 'watch')
+    patches_before = len(store.patches)
+
+    changed_at = {}
+    start = time.time()
+    for r in range(args.repeat):
+        for (namespace, kind, name) in changed:
+            plural = 'configmaps' if kind == 'ConfigMap' else 'secrets'
+            obj = store.update(plural, namespace, name, lambda obj: obj['data'].update({'key': 'djE='}))
+            changed_at.setdefault((namespace, kind, name), time.time())
+
+    patched = {}
+    while len(patched) < len(expected) and time.time() - start < args.deadline:
+        for (patch_time, plural, namespace, name, body) in store.patches[patches_before:]:
+            if (namespace, name) not in patched:
+                patched[(namespace, name)] = (patch_time, body)
+        time.sleep(0.1)
+    duration = time.time() - start
+
+    latencies = []
+    for (namespace, name) in patched:
+        (patch_time, body) = patched[(namespace, name)]
+        for key_ann in body['spec']['template']['metadata']['annotations']:
+            (kind, cfg_name) = key_ann.split('/', 1)[1].split('.', 1)
+            if (namespace, kind, cfg_name) in changed_at:
+                latencies.append(patch_time - changed_at[(namespace, kind, cfg_name)])
+
+    calls = sum(count for ((verb, plural), count) in store.calls.items() if verb != 'watch') - calls_before
+    report.update({
+            'changes': len(changed) * args.repeat,
+            'expected_patches': len(expected),
+            'patches': len(store.patches) - patches_before,
+            'missing_patches': len(expected) - len(patched),
+            'burst_seconds': duration,
+            'events_per_second': len(changed) * args.repeat / duration,
+            'latency_p50': percentile(latencies, 50),
+            'latency_p90': percentile(latencies, 90),
+            'latency_p99': percentile(latencies, 99),
+            'latency_max': percentile(latencies, 100),
+            'api_calls_per_change': float(calls) / max(len(changed) * args.repeat, 1),
+            'peak_rss_mb': get_rss_mb(),
+            'config_mb_sent': (store.bytes_sent['configmaps'] + store.bytes_sent['secrets']) / 1048576.0,
+            })
+
+    if args.json:
+        print(json.dumps(report, sort_keys=True))
+    else:
+        for key in sorted(report):
+            print('%-22s %s' % (key, round(report[key], 3) if isinstance(report[key], float) else report[key]))
+    return 0 if report['missing_patches'] == 0 and report['patches_at_start'] == 0 else 1
+
+if __name__ == '__main__':
+    code = main()
+    sys.stdout.flush()
+    # don't wait for the daemon threads blocked in watches
+    os._exit(code)
@@ -0,0 +1,308 @@
+import logging, threading, time, json, re, copy, collections, urlparse, gzip, StringIO
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+RESOURCES = {
+        'configmaps': ('/api/v1', 'ConfigMap'),
+        'secrets': ('/api/v1', 'Secret'),
+        'pods': ('/api/v1', 'Pod'),
+        'replicationcontrollers': ('/api/v1', 'ReplicationController'),
+        'daemonsets': ('/apis/extensions/v1beta1', 'DaemonSet'),
+        'deployments': ('/apis/extensions/v1beta1', 'Deployment'),
+        'replicasets': ('/apis/extensions/v1beta1', 'ReplicaSet'),
+        'statefulsets': ('/apis/apps/v1beta1', 'StatefulSet'),
+        }
+
+PATH_RE = re.compile(r'^(/api/v1|/apis/[^/]+/[^/]+)(?:/namespaces/([^/]+))?/([a-z]+)(?:/([^/]+))?$')
+
+class FakeApiStore():
+    def __init__(self, event_window=100000):
+        """
+        In memory objects of a fake kubernetes cluster
+
+        Every change gets a new resourceVersion and is recorded as a watch event.
+        Only the last event_window events are kept. Watching from an older version returns 410 Gone
+        """
+
+        self.log = logging.getLogger(__name__)
+        self.objects = dict((plural, {}) for plural in RESOURCES)
+        # events[i] has resourceVersion first_version + i
+        self.events = []
+        self.first_version = 1
+        self.event_window = event_window
+        self.resource_version = 0
+        self.cond = threading.Condition()
+        self.calls = collections.Counter()
+        self.bytes_sent = collections.Counter()
+        self.patches = []
+
+    def create(self, plural, obj):
+        """
+        Add the object and return it
+        """
+
+        with self.cond:
+            obj = copy.deepcopy(obj)
+            obj.setdefault('apiVersion', RESOURCES[plural][0].split('/', 2)[-1])
+            obj['kind'] = RESOURCES[plural][1]
+            obj['metadata'].setdefault('generation', 1)
+            self.objects[plural][(obj['metadata']['namespace'], obj['metadata']['name'])] = obj
+            self.record(plural, 'ADDED', obj)
+            return obj
+
+    def update(self, plural, namespace, name, func):
+        """
+        Change the object in place with func(obj) and return it
+        """
+
+        with self.cond:
+            obj = self.objects[plural][(namespace, name)]
+            func(obj)
+            self.record(plural, 'MODIFIED', obj)
+            return obj
+
+    def patch(self, plural, namespace, name, body):
+        """
+        Apply a merge patch. A change of the spec bumps the generation.
+        Controllers are rolled out instantly
+        """
+
+        with self.cond:
+            obj = self.objects[plural].get((namespace, name))
+            if obj is None:
+                return None
+            spec = json.dumps(obj.get('spec'), sort_keys=True)
+            merge_patch(obj, body)
+            if json.dumps(obj.get('spec'), sort_keys=True) != spec:
+                obj['metadata']['generation'] += 1
+            if 'status' in obj and 'observedGeneration' in obj['status']:
+                obj['status']['observedGeneration'] = obj['metadata']['generation']
+            self.patches.append((time.time(), plural, namespace, name, body))
+            self.record(plural, 'MODIFIED', obj)
+            return obj
+
+    def delete(self, plural, namespace, name):
+        """
+        Remove the object and return it
+        """
+
+        with self.cond:
+            obj = self.objects[plural].pop((namespace, name), None)
+            if obj is not None:
+                self.record(plural, 'DELETED', obj)
+            return obj
+
+    def record(self, plural, event_type, obj):
+        """
+        Give the object a new resourceVersion and wake up the watchers
+        Must be called with the lock held
+        """
+
+        self.resource_version += 1
+        obj['metadata']['resourceVersion'] = str(self.resource_version)
+        self.events.append((plural, obj['metadata']['namespace'], json.dumps({'type': event_type, 'object': obj})))
+        if len(self.events) > self.event_window:
+            drop = len(self.events) - self.event_window / 2
+            del self.events[:drop]
+            self.first_version += drop
+        self.cond.notify_all()
+
+    def list(self, plural, namespace, limit=None, cont=None):
+        """
+        Return the items, the list resourceVersion and the continue token
+        """
+
+        with self.cond:
+            if cont:
+                (offset, version) = cont.split(':')
+                offset = int(offset)
+            else:
+                (offset, version) = (0, str(self.resource_version))
+            items = sorted((key, obj) for (key, obj) in self.objects[plural].items() if namespace is None or key[0] == namespace)
+            if limit:
+                page = items[offset:offset + limit]
+                cont = str(offset + limit) + ':' + version if offset + limit < len(items) else None
+            else:
+                page = items[offset:]
+                cont = None
+            return (json.dumps([obj for (key, obj) in page]), version, cont)
+
+    def get_events(self, plural, namespace, version, timeout):
+        """
+        Wait for events newer than version. Return None if version is too old
+        """
+
+        with self.cond:
+            if version < self.first_version - 1:
+                return None
+            while True:
+                start = version + 1 - self.first_version
+                found = [(self.first_version + start + i, data) for (i, (p, ns, data)) in enumerate(self.events[start:])
+                         if p == plural and (namespace is None or ns == namespace)]
+                if found:
+                    return found
+                # nothing for us, but we can skip what was already checked
+                version = self.resource_version
+                if timeout <= 0:
+                    return found
+                wait_start = time.time()
+                self.cond.wait(timeout)
+                timeout -= time.time() - wait_start
+
+def to_metadata(obj):
+    """
+    PartialObjectMetadata of an object
+    """
+
+    return {'kind': 'PartialObjectMetadata', 'apiVersion': 'meta.k8s.io/v1', 'metadata': obj['metadata']}
+
+def merge_patch(obj, patch):
+    """
+    RFC 7386 merge patch
+    """
+
+    for key in patch:
+        if patch[key] is None:
+            obj.pop(key, None)
+        elif isinstance(patch[key], dict) and isinstance(obj.get(key), dict):
+            merge_patch(obj[key], patch[key])
+        else:
+            obj[key] = copy.deepcopy(patch[key])
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """
+    Serve list, watch, get, patch and delete for the resources of the store
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def parse(self):
+        url = urlparse.urlparse(self.path)
+        match = PATH_RE.match(url.path)
+        if not match or match.group(3) not in RESOURCES:
+            self.send_json(404, {'kind': 'Status', 'code': 404, 'message': 'not found'})
+            return None
+        query = dict((key, values[0]) for (key, values) in urlparse.parse_qs(url.query).items())
+        return (match.group(3), match.group(2), match.group(4), query)
+
+    def send_json(self, code, obj, data=None, plural=None):
+        data = data if data is not None else json.dumps(obj)
+        compress = 'gzip' in (self.headers.getheader('Accept-Encoding') or '')
+        if compress:
+            buf = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=1) as f:
+                f.write(data)
+            data = buf.getvalue()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if plural:
+            self.server.store.bytes_sent[plural] += len(data)
+        self.wfile.write(data)
+
+    def send_chunk(self, data):
+        self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        parsed = self.parse()
+        if parsed is None:
+            return
+        (plural, namespace, name, query) = parsed
+        store = self.server.store
+        metadata_only = 'as=PartialObjectMetadata' in (self.headers.getheader('Accept') or '')
+        if query.get('watch', '').lower() == 'true':
+            store.calls[('watch', plural)] += 1
+            return self.watch(plural, namespace, query, metadata_only)
+        if name:
+            store.calls[('get', plural)] += 1
+            obj = store.objects[plural].get((namespace, name))
+            if obj is None:
+                return self.send_json(404, {'kind': 'Status', 'code': 404, 'message': 'not found'})
+            return self.send_json(200, obj, plural=plural)
+        store.calls[('list', plural)] += 1
+        limit = int(query['limit']) if 'limit' in query else None
+        (items, version, cont) = store.list(plural, namespace, limit, query.get('continue'))
+        if metadata_only:
+            items = json.dumps([to_metadata(obj) for obj in json.loads(items)])
+        metadata = {'resourceVersion': version}
+        if cont:
+            metadata['continue'] = cont
+        data = '{"kind": "%sList", "apiVersion": "v1", "metadata": %s, "items": %s}' % (RESOURCES[plural][1], json.dumps(metadata), items)
+        self.send_json(200, None, data, plural)
+
+    def watch(self, plural, namespace, query, metadata_only=False):
+        store = self.server.store
+        version = int(query.get('resourceVersion') or store.resource_version)
+        deadline = time.time() + int(query.get('timeoutSeconds', 300))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            while time.time() < deadline:
+                events = store.get_events(plural, namespace, version, min(1, deadline - time.time()))
+                if events is None:
+                    status = {'kind': 'Status', 'code': 410, 'reason': 'Gone', 'message': 'too old resource version'}
+                    self.send_chunk(json.dumps({'type': 'ERROR', 'object': status}) + '\n')
+                    break
+                for (rv, data) in events:
+                    if metadata_only:
+                        event = json.loads(data)
+                        data = json.dumps({'type': event['type'], 'object': to_metadata(event['object'])})
+                    store.bytes_sent[plural] += len(data) + 1
+                    self.send_chunk(data + '\n')
+                    version = rv
+            self.send_chunk('')
+        except IOError:
+            pass
+        self.close_connection = 1
+
+    def do_PATCH(self):
+        parsed = self.parse()
+        if parsed is None:
+            return
+        (plural, namespace, name, query) = parsed
+        body = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length'))))
+        self.server.store.calls[('patch', plural)] += 1
+        obj = self.server.store.patch(plural, namespace, name, body)
+        if obj is None:
+            return self.send_json(404, {'kind': 'Status', 'code': 404, 'message': 'not found'})
+        self.send_json(200, obj)
+
+    def do_DELETE(self):
+        parsed = self.parse()
+        if parsed is None:
+            return
+        (plural, namespace, name, query) = parsed
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self.server.store.calls[('delete', plural)] += 1
+        obj = self.server.store.delete(plural, namespace, name)
+        if obj is None:
+            return self.send_json(404, {'kind': 'Status', 'code': 404, 'message': 'not found'})
+        self.send_json(200, {'kind': 'Status', 'code': 200, 'status': 'Success'})
+
+class FakeApiServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded http server around a FakeApiStore
+    """
+
+    daemon_threads = True
+
+    def __init__(self, store, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeApiHandler)
+        self.store = store
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return 'http://127.0.0.1:%s' % self.server_address[1]
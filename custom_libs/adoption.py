@@ -0,0 +1,158 @@
+import logging, threading, time
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from custom_libs import annotations, workloadindex, metrics, apiclient
+
+class threadAdoption (threading.Thread):
+    def __init__(self, name, cache, digests=None, batch_size=20, batch_interval=1):
+        """
+        Record the current versions of the configs on all controllers with our signature
+        that don't have them yet, without restarting any pod
+
+        The versions are written in the controller metadata, not in the pod template.
+        After this, the watchers find the versions and only real changes restart pods
+
+        Patches are done in batches of batch_size, with batch_interval seconds between them.
+        The finished event is set when all controllers were adopted and the workload cache
+        has seen the new annotations
+        """
+
+        threading.Thread.__init__(self)
+        self.log = logging.getLogger(__name__ + " " + name)
+        self.log.info("Init threadAdoption")
+        self.cache = cache
+        self.digests = digests
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.v1 = client.CoreV1Api(apiclient.get_api_client())
+        self.v1b1 = client.AppsV1beta1Api(apiclient.get_api_client())
+        self.v1b1e = client.ExtensionsV1beta1Api(apiclient.get_api_client())
+        self.ann = annotations.Annotations()
+        self.patch_functions = {
+                'DaemonSet': self.v1b1e.patch_namespaced_daemon_set,
+                'Deployment': self.v1b1e.patch_namespaced_deployment,
+                'ReplicationController': self.v1.patch_namespaced_replication_controller,
+                'StatefulSet': self.v1b1.patch_namespaced_stateful_set,
+                }
+        self.read_functions = {
+                'ConfigMap': self.v1.read_namespaced_config_map,
+                'Secret': self.v1.read_namespaced_secret,
+                }
+        self.configs = {}
+        self.total = 0
+        self.adopted = 0
+        self.finished = threading.Event()
+
+    def run(self):
+        """
+        Find all controllers that need adoption and patch them
+        """
+        self.log.info("Starting thread")
+
+        try:
+            pending = self.get_pending()
+            self.total = len(pending)
+            self.log.info("Adopting %s controllers", self.total)
+            adopted = []
+            for start in range(0, len(pending), self.batch_size):
+                for (kind, namespace, name, changes) in pending[start:start + self.batch_size]:
+                    if self.adopt(kind, namespace, name, changes):
+                        adopted.append((kind, namespace, name, changes))
+                self.log.info("Adopted %s/%s controllers", self.adopted, self.total)
+                if start + self.batch_size < len(pending):
+                    time.sleep(self.batch_interval)
+            self.wait_for_cache(adopted)
+        except BaseException as e:
+            self.log.exception('{!r}. Adoption stopped.'.format(e))
+        self.configs = {}
+        self.log.info("Adoption finished")
+        self.finished.set()
+
+    def get_pending(self):
+        """
+        Return a list of (kind, namespace, name, changes) for controllers with our signature
+        that miss the version of any of their configs
+        """
+        self.log.debug("get_pending")
+
+        pending = []
+        for kind in self.patch_functions:
+            for res in self.cache.list(None, kind):
+                if not self.ann.has_signature(res):
+                    continue
+                changes = {}
+                refs = workloadindex.get_references(res)
+                for (cfg_kind, cfg_name) in refs:
+                    if self.ann.get_version(res, cfg_kind, cfg_name) is not False:
+                        continue
+                    version = self.get_config_version(res.metadata.namespace, cfg_kind, cfg_name, refs[(cfg_kind, cfg_name)])
+                    if version is not None:
+                        changes[self.ann.get_annotation(cfg_kind, cfg_name)] = version
+                if changes:
+                    pending.append((kind, res.metadata.namespace, res.metadata.name, changes))
+        return pending
+
+    def get_config_version(self, namespace, kind, name, keys):
+        """
+        Read the config (once for the whole adoption) and return its version
+        None if the config doesn't exist
+        """
+        self.log.debug("get_config_version %s %s/%s", kind, namespace, name)
+
+        key = (namespace, kind, name)
+        if key not in self.configs:
+            try:
+                with metrics.api_timer('get', kind):
+                    obj = self.read_functions[kind](name, namespace)
+                obj.kind = kind
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+                obj = None
+            self.configs[key] = obj
+        obj = self.configs[key]
+        if obj is None:
+            return None
+        if self.digests:
+            return self.digests.get_digest(obj, keys)
+        return obj.metadata.resource_version
+
+    def adopt(self, kind, namespace, name, changes):
+        """
+        Write the versions in the controller metadata
+        Return True if the patch was successful
+        """
+        self.log.info("Adopt %s %s/%s", kind, namespace, name)
+
+        body = self.ann.build_adoption_annotation(changes)
+        try:
+            with metrics.api_timer('patch', kind):
+                self.patch_functions[kind](name=name, namespace=namespace, body=body)
+            self.adopted += 1
+            return True
+        except ApiException as e:
+            self.log.critical("Exception when calling patch_function: %s\n" % e)
+            return False
+
+    def wait_for_cache(self, pending, timeout=60):
+        """
+        The watchers read the versions from the workload cache.
+        Wait until the cache received our patches, otherwise they would restart the pods
+        """
+        self.log.info("Waiting for the workload cache to see the adopted versions")
+
+        deadline = time.time() + timeout
+        while pending and time.time() < deadline:
+            waiting = []
+            for (kind, namespace, name, changes) in pending:
+                res = self.cache.get(namespace, name, kind)
+                if res is None:
+                    continue
+                annotations = res.metadata.annotations or {}
+                if any(annotations.get(key_ann) != changes[key_ann] for key_ann in changes):
+                    waiting.append((kind, namespace, name, changes))
+            pending = waiting
+            if pending:
+                time.sleep(1)
+        if pending:
+            self.log.error("Workload cache doesn't have the adopted versions for %s controllers", len(pending))
@@ -10,6 +10,10 @@ class Annotations():
         self.opsguru_domain = 'opsguru.signature'
         self.opsguru_signature = self.opsguru_domain +'/should_update'
         self.opsguru_signature_value = 'True'
+        self.opsguru_debounce = self.opsguru_domain + '/debounce'
+        self.opsguru_max_wait = self.opsguru_domain + '/max-wait'
+        self.opsguru_max_unavailable = self.opsguru_domain + '/max-unavailable'
+        self.opsguru_partition = self.opsguru_domain + '/partition'
 
     def has_signature(self, res):
         """
@@ -22,21 +26,37 @@ class Annotations():
             return True
         return False
 
+    def get_number(self, res, key_ann):
+        """
+        Return the number from an annotation of the controller
+        None if it's missing or not a number
+        """
+        self.log.debug("get_number")
+
+        annotations = res.metadata.annotations if res is not None else None
+        if not annotations or key_ann not in annotations:
+            return None
+        try:
+            return max(float(annotations[key_ann]), 0)
+        except ValueError:
+            self.log.warning("Invalid %s on %s/%s: %s", key_ann, res.metadata.namespace, res.metadata.name, annotations[key_ann])
+            return None
+
     def get_version(self, res, kind, name):
         """
         Check if the controller has any annotation for the respective config
         Return False if we don't find it, otherwise return the value
+
+        The pod template annotation is the one that restarted the pods.
+        If it's missing, we look at the version recorded on the controller on adoption
         """
         self.log.debug("get_version")
 
-        annotations =  res.spec.template.metadata.annotations
-        if not annotations:
-            return False
         key_ann = self.get_annotation(kind, name)
-        if key_ann in annotations:
-            return annotations[key_ann]
-        else:
-            return False
+        for annotations in (res.spec.template.metadata.annotations, res.metadata.annotations):
+            if annotations and key_ann in annotations:
+                return annotations[key_ann]
+        return False
 
     def get_annotation(self, kind, name):
         """
@@ -58,3 +78,16 @@ class Annotations():
             ann_list.append('"' + change + '": "' + changes[change] + '"')
         annotation = '{"spec": {"template": {"metadata":{"annotations":{' + ",".join(ann_list) + '}}}}}'
         return yaml.load(annotation)
+
+    def build_adoption_annotation(self, changes):
+        """
+        Built the annotation for patching the controller metadata.
+        The pod template is not changed, so nothing is restarted
+        """
+        self.log.debug("build_adoption_annotation")
+
+        ann_list = []
+        for change in changes:
+            ann_list.append('"' + change + '": "' + changes[change] + '"')
+        annotation = '{"metadata":{"annotations":{' + ",".join(ann_list) + '}}}'
+        return yaml.load(annotation)
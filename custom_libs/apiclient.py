@@ -0,0 +1,89 @@
+import logging, threading
+from kubernetes import client, watch
+from custom_libs import metrics
+
+api_client = None
+api_client_lock = threading.Lock()
+# objects per page when listing, 0 to list everything at once
+page_size = 500
+
+class PooledApiClient(client.ApiClient):
+    def __init__(self, configuration=None, gzip=True):
+        """
+        ApiClient that asks for compressed responses
+
+        Watches are read as a raw stream by watch.Watch, without decoding,
+        so only the other GET requests are compressed
+        """
+
+        client.ApiClient.__init__(self, configuration)
+        self.gzip = gzip
+
+    def call_api(self, resource_path, method, path_params=None, query_params=None, header_params=None, *args, **kwargs):
+        if self.gzip and method == 'GET' and not any(key == 'watch' for (key, value) in query_params or []):
+            header_params = dict(header_params or {})
+            header_params['Accept-Encoding'] = 'gzip'
+        return client.ApiClient.call_api(self, resource_path, method, path_params, query_params, header_params, *args, **kwargs)
+
+class SharedWatch(watch.Watch):
+    def __init__(self, return_type=None):
+        """
+        Watch that deserializes the events with the shared ApiClient
+
+        watch.Watch creates an ApiClient, with its own thread pool and connection pool,
+        only to deserialize. We don't call its __init__, so it's never created
+        """
+
+        self._raw_return_type = return_type
+        self._stop = False
+        self._api_client = get_api_client()
+
+def setup(pool_size=None, gzip=True, list_page_size=500):
+    """
+    Create the ApiClient shared by all api objects
+    Must be called after the kubernetes config is loaded
+
+    Every ApiClient has its own connection pool and thread pool, so we only want one.
+    pool_size is the number of connections kept open to the api server
+    """
+    global api_client, page_size
+    log = logging.getLogger(__name__)
+
+    configuration = client.Configuration()
+    if pool_size:
+        configuration.connection_pool_maxsize = pool_size
+    log.info("Using %s connections to %s, gzip %s", configuration.connection_pool_maxsize, configuration.host, gzip)
+    page_size = list_page_size
+    with api_client_lock:
+        api_client = PooledApiClient(configuration, gzip)
+    return api_client
+
+def get_api_client():
+    """
+    Return the shared ApiClient, created with the defaults on first use
+    """
+    global api_client
+
+    with api_client_lock:
+        if api_client is None:
+            api_client = PooledApiClient(client.Configuration())
+        return api_client
+
+def list_pages(list_func, resource, limit, *args, **kwargs):
+    """
+    Call list_func for one page of at most limit objects at a time and yield the pages
+    All pages are from the same snapshot and have the resourceVersion of the first one.
+    With limit 0 everything is listed at once
+
+    If the snapshot is too old to continue, the api returns 410 Gone and we raise it
+    """
+
+    if limit:
+        kwargs['limit'] = limit
+    while True:
+        with metrics.api_timer('list', resource):
+            page = list_func(*args, **kwargs)
+        yield page
+        if not limit or not page.metadata._continue:
+            return
+        kwargs['_continue'] = page.metadata._continue
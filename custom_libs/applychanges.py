@@ -1,19 +1,52 @@
-import logging, threading, time, json
+import logging, threading, time, heapq, itertools, socket
 from kubernetes import client
 from kubernetes.client.rest import ApiException
-from custom_libs import annotations
+from urllib3.exceptions import HTTPError
+from custom_libs import annotations, delayqueue, workqueue, ratelimit, rolloutbudget, metrics, debounce, apiclient, restarter
 
 class threadApplyChanges (threading.Thread):
-    def __init__(self, name, queue, timer_timeout=300):
+    def __init__(self, name, queue, cache, pod_cache, timer_timeout=300, retry_delay=1, max_retry_delay=300,
+                 patch_workers=10, patch_retries=5, max_rollouts=0, max_rollouts_per_namespace=0,
+                 patch_rate=0, patch_burst=1, budget_retry_delay=5, min_debounce=None, max_wait=None,
+                 max_unavailable='25%', restart_interval=5, rollout_timeout=600):
         """
         For each controller that needs updated, write a custom annotation
         and maybe restart the necessary pods
 
-        Receives a queue with what needs updating
+        Receives a queue with what needs updating, the shared workload cache
+        and the pod cache
 
         Main run thread is the only worker. Another thread is spawn for the update function.
         The main class thread and the update thread both use for_update dict
-        to write/delete, so a lock is used to ensure they don't step on each other toes
+        to write/delete, so a lock is used to ensure they don't step on each other toes.
+        The update thread only takes the expired elements out of the dict. The patches are done
+        by a pool of patch_workers threads, outside of the lock. Failed patches are retried
+        patch_retries times
+
+        Before patching, the controller must fit in the rollout budget: at most max_rollouts
+        rollouts in progress globally and max_rollouts_per_namespace in each namespace.
+        Otherwise it stays in the update dict and we try again after budget_retry_delay seconds.
+        Rollouts that didn't finish after rollout_timeout seconds stop counting.
+        Patches are limited to patch_rate per second with bursts of patch_burst
+
+        Another thread moves the elements from the queue into a delay queue.
+        Controllers that are not ready are retried from the delay queue
+        after retry_delay seconds, doubled on every failure up to max_retry_delay.
+        Elements of controllers that were deleted meanwhile are dropped
+
+        Controllers are patched when no new change came for a debounce window, learned for each of them
+        between min_debounce and timer_timeout seconds, but at most max_wait seconds after the first change.
+        By default both are timer_timeout, so every controller waits timer_timeout after its first change.
+        The annotations opsguru.signature/debounce and opsguru.signature/max-wait of a controller
+        replace the learned window and max_wait
+
+        Kubernetes doesn't roll ReplicationControllers and StatefulSets with the OnDelete strategy.
+        After patching them, their pods are restarted by a threadRestarter, in batches of
+        at most max_unavailable pods every restart_interval seconds. They count as rolling
+        in the budget until all pods are restarted
+
+        Elements from the delay queue and the update dict, including the ones being patched,
+        can be saved with get_checkpoint and loaded again with restore
         """
 
         threading.Thread.__init__(self)
@@ -21,22 +54,75 @@ class threadApplyChanges (threading.Thread):
         self.log.info("Init threadApplyChanges")
         global opsguru_signature
         self.timer_timeout = timer_timeout
+        self.max_wait = max_wait if max_wait is not None else timer_timeout
+        self.debouncer = debounce.Debouncer(name, min_debounce if min_debounce is not None else timer_timeout, timer_timeout)
         self.q = queue
-        self.v1 = client.CoreV1Api()
-        self.v1b1 = client.AppsV1beta1Api()
-        self.v1b2 = client.AppsV1beta2Api()
-        self.v1b1e = client.ExtensionsV1beta1Api()
+        self.cache = cache
+        self.pod_cache = pod_cache
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.delayed = delayqueue.DelayQueue(name)
+        self.failures = {}
+        # elements received from the queue that are not in the update dict yet
+        self.waiting = {}
+        self.waiting_lock = threading.Lock()
+        self.v1 = client.CoreV1Api(apiclient.get_api_client())
+        self.v1b1 = client.AppsV1beta1Api(apiclient.get_api_client())
+        self.v1b2 = client.AppsV1beta2Api(apiclient.get_api_client())
+        self.v1b1e = client.ExtensionsV1beta1Api(apiclient.get_api_client())
         self.ann = annotations.Annotations()
+        self.patch_retries = patch_retries
+        self.restarter = restarter.threadRestarter(name, cache, pod_cache, max_unavailable, restart_interval)
+        self.restarter.daemon = True
+        self.restarter.start()
+        self.budget = rolloutbudget.RolloutBudget(cache, max_rollouts, max_rollouts_per_namespace, self.restarter, rollout_timeout)
+        self.budget_retry_delay = budget_retry_delay
+        self.patch_limiter = ratelimit.TokenBucket(name + " patch", patch_rate, patch_burst)
         self.for_update = {}
-        self.for_update_lock = threading.Lock()
+        # elements taken out of the update dict by the patch workers
+        self.patching = {}
+        self.for_update_lock = threading.Condition()
+        # heap of (expiry, count, key) for the elements from for_update
+        self.schedule = []
+        self.counter = itertools.count()
+        self.patch_pool = workqueue.WorkerPool(name + " patch", self.process_patch, patch_workers)
+        self.patch_pool.start()
+        metrics.queue_depth.labels('for_update').set_function(lambda: len(self.for_update))
+        metrics.queue_depth.labels('not_ready').set_function(lambda: len(self.delayed))
 
         t = threading.Thread(target=self.update)
         t.daemon = True
         t.start()
 
+        t = threading.Thread(target=self.intake)
+        t.daemon = True
+        t.start()
+
+    def intake(self):
+        """
+        Move the elements from the queue into the delay queue, ready to be processed now
+        The same controller and config is processed only once, with the newest version
+        """
+        self.log.info("Intake thread started")
+
+        while True:
+            item = self.q.get()
+            key = self.get_item_key(item)
+            with self.waiting_lock:
+                self.waiting[key] = item
+            self.delayed.put(key, item)
+            self.q.task_done()
+
+    def get_item_key(self, item):
+        """
+        Elements are identified by the controller and the config
+        """
+
+        return (item['res_namespace'], item['res_kind'], item['res_name'], item['cfg_kind'], item['cfg_name'])
+
     def run(self):
         """
-        Start getting elements from the queue. If the queue is empty, wait for more elements
+        Start getting elements from the delay queue. If nothing is due, wait for it
 
         We consider that the elements needs to be restarted if the resource_version of the config
         is different then the one that we add as an annotation to the controller
@@ -45,155 +131,337 @@ class threadApplyChanges (threading.Thread):
 
         Each element consists of an updated config/secret and a controller that needs to be restarted
         Since we can have cascading updates for different cms/secrets (user updates multiple cm at intervals of a few minutes),
-        we put a timer for each controller. The timer is considered expired when crt_time - item_time > timer_timeout
-        If we get an update for the same controller we reset item_time = crt_time
+        we put a timer for each controller. The timer is considered expired when no update came for its debounce window
+        or max_wait seconds passed since the first update
 
         For each controller set the necessary patch function and who should perform the update
         On kube 1.6:
          - only daemonsets and deployments have rolling updates
          - daemonset needs to have spec.updateStrategy.type=RollingUpdate. We are not managing this
-         - replication_controllers and stateful_sets need to be updated manually
+         - replication_controllers and stateful_sets need to be updated manually, their pods are restarted by us
         """
         self.log.info("Starting thread")
 
-        def f(x):
-            return {
-                    'DaemonSet': (self.update_rollingupdate, self.v1b1e.patch_namespaced_daemon_set),
-                    'Deployment': (self.update_rollingupdate, self.v1b1e.patch_namespaced_deployment),
-                    'ReplicationController': (self.update_manually, self.v1.patch_namespaced_replication_controller),
-                    'StatefulSet': (self.update_manually, self.v1b1.patch_namespaced_stateful_set),
-                    }.get(x)
-
         while True:
             try:
-                item = self.q.get()
+                (key, item) = self.delayed.get()
 
-                if self.should_update(item):
+                start = time.time()
+                ready = self.should_update(item)
+                metrics.should_update_duration.observe(time.time() - start)
+                if ready:
+                    self.failures.pop(key, None)
                     kind = item['res_kind']
                     key_res = item['res_namespace'] + "/" + item['res_name']
                     key_ann = self.ann.get_annotation(item['cfg_kind'], item['cfg_name'])
                     self.log.info("Needs update: %s %s by %s" % (kind, key_res, item['cfg_kind'] + '/' + item['cfg_name']))
+                    (quiet, max_wait) = self.get_debounce(key_res, kind, item)
                     with self.for_update_lock:
                         if key_res in self.for_update:
-                            self.for_update[key_res]['changes'].update({key_ann: item['cfg_version']})
+                            value = self.for_update[key_res]
+                            expiry = self.get_expiry(value)
+                            value['changes'].update({key_ann: item['cfg_version']})
+                            value['event_time'] = min(value['event_time'], item['event_time'])
+                            value.update({'last': time.time(), 'quiet': quiet, 'max_wait': max_wait})
+                            if self.get_expiry(value) != expiry:
+                                self.add_for_update(key_res, value)
                         else:
-                            (update_function, patch_func) = f(kind)
+                            (update_function, patch_func) = self.get_functions(kind)
                             value = {}
                             value.update({'name':  item['res_name']})
                             value.update({'namespace': item['res_namespace']})
                             value.update({'changes': {key_ann: item['cfg_version']}})
                             value.update({'time': time.time()})
+                            value.update({'last': value['time']})
+                            value.update({'quiet': quiet})
+                            value.update({'max_wait': max_wait})
                             value.update({'patch_func': patch_func})
                             value.update({'update_function': update_function})
                             value.update({'kind': kind})
-                            self.for_update.update({key_res: value})
+                            value.update({'retries': 0})
+                            value.update({'event_time': item['event_time']})
+                            self.add_for_update(key_res, value)
+                    with self.waiting_lock:
+                        if self.waiting.get(key) is item:
+                            del self.waiting[key]
+                elif self.cache.get(item['res_namespace'], item['res_name'], item['res_kind']) is None:
+                    self.log.info("%s %s/%s does not exist anymore", item['res_kind'], item['res_namespace'], item['res_name'])
+                    self.failures.pop(key, None)
+                    with self.waiting_lock:
+                        if self.waiting.get(key) is item:
+                            del self.waiting[key]
                 else:
                     # put the item back if not ready
-                    self.log.info("We don't update %s yet. Not ready.", item['res_name'])
-                    self.q.put(item)
- 
-                self.q.task_done()
-                time.sleep(1)
+                    failures = self.failures.get(key, 0)
+                    delay = min(self.retry_delay * 2 ** failures, self.max_retry_delay)
+                    self.failures[key] = failures + 1
+                    # a newer item that came meanwhile is already in the delay queue, don't replace it
+                    # the lock keeps intake from putting a newer one before us
+                    with self.waiting_lock:
+                        if self.waiting.get(key) is item:
+                            self.log.info("We don't update %s yet. Not ready. Retry in %ss", item['res_name'], delay)
+                            self.delayed.put(key, item, delay)
             except BaseException as e:
                 self.log.exception('{!r}. Restarting thread.'.format(e))
                 time.sleep(1)
         self.log.info("Thread has been stopped")
 
+    def get_functions(self, kind):
+        """
+        Return who should perform the update and the patch function for the kind of controller
+        """
+
+        return {
+                'DaemonSet': (self.update_rollingupdate, self.v1b1e.patch_namespaced_daemon_set),
+                'Deployment': (self.update_rollingupdate, self.v1b1e.patch_namespaced_deployment),
+                'ReplicationController': (self.update_manually, self.v1.patch_namespaced_replication_controller),
+                'StatefulSet': (self.update_manually, self.v1b1.patch_namespaced_stateful_set),
+                }.get(kind)
+
+    def get_debounce(self, key_res, kind, item):
+        """
+        Return how long to wait for more changes of the controller and the maximum wait
+        The annotations of the controller win over what we learned. With a fixed debounce
+        we don't learn anything
+        """
+
+        res = self.cache.get(item['res_namespace'], item['res_name'], kind)
+        quiet = self.ann.get_number(res, self.ann.opsguru_debounce)
+        if quiet is None:
+            quiet = self.debouncer.observe(key_res, item['event_time'])
+        max_wait = self.ann.get_number(res, self.ann.opsguru_max_wait)
+        if max_wait is None:
+            max_wait = self.max_wait
+        metrics.debounce.observe(min(quiet, max_wait))
+        return (quiet, max_wait)
+
     def should_update(self, item):
         """
         Check that all pods from the controller are running
         """
         self.log.info("Check if we should update %s %s", item['res_kind'], item['res_name'])
 
-        try:
-            pods = self.get_pods_for_controller(item['res_namespace'], item['res_name'], item['res_kind'])
-            if not pods:
-                self.log.info("No pods found for %s %s", item['res_kind'], item['res_name'])
+        pods = self.get_pods_for_controller(item['res_namespace'], item['res_name'], item['res_kind'])
+        if not pods:
+            self.log.info("No pods found for %s %s", item['res_kind'], item['res_name'])
+            return False
+        for pod in pods:
+            if pod.status.phase != 'Running':
+                self.log.info("Pod name %s is %s", pod.metadata.name, pod.status.phase)
                 return False
-            for pod in pods:
-                if pod.status.phase != 'Running':
-                    self.log.info("Pod name %s is %s", pod.metadata.name, pod.status.phase)
-                    return False
-            return True
-        except ApiException as e:
-            self.log.critical("Exception when calling read_function: %s\n" % e)
+        return True
+
+    def add_for_update(self, key, value):
+        """
+        Add the element in the update dict and schedule it at its expiry time
+        Must be called with for_update_lock held
+        """
+        self.log.debug("add_for_update %s", key)
+
+        self.for_update.update({key: value})
+        heapq.heappush(self.schedule, (self.get_expiry(value), next(self.counter), key))
+        self.for_update_lock.notify()
+
+    def get_expiry(self, value):
+        """
+        Elements expire when no change came for their debounce window,
+        but no later than max_wait seconds after they were added
+        Failed patches are retried at their own time
+        """
+
+        if 'retry_at' in value:
+            return value['retry_at']
+        return min(value['last'] + value['quiet'], value['time'] + value['max_wait'])
 
     def update(self):
         """
-        Every 5 seconds block the update dict and start looking for elements that have the timer expired
-        If the update is successful delete the key from dict
+        Sleep until the first element from the update dict has the timer expired
+        Take out of the dict all expired elements and send them to the patch workers
         """
         self.log.info("Update thread started")
 
         while True:
-            time.sleep(5)
+            expired = []
             with self.for_update_lock:
-                for key in list(self.for_update):
-                    if time.time() - self.for_update[key]['time'] > self.timer_timeout:
-                        self.log.info("We will update %s", self.for_update[key]['name'])
-                        name = self.for_update[key]['name']
-                        namespace = self.for_update[key]['namespace']
-                        body = self.ann.build_annotation(self.for_update[key]['changes'])
-                        try:
-                            patch_function = self.for_update[key]['patch_func']
-                            patch_function(name=name, namespace=namespace, body=body)
-                            update_function = self.for_update[key]['update_function']
-                            update_function(name=name, namespace=namespace, self.for_update[key]['kind'])
-                            del self.for_update[key]
-                        except ApiException as e:
-                            self.log.critical("Exception when calling patch_function: %s\n" % e)
-                    else:
-                        self.log.info("We will not update %s yet.", self.for_update[key]['name'])
-
-    def update_rollingupdate(self, namespace, name, kind):
+                while not expired:
+                    # drop schedule entries for elements that were removed or rescheduled
+                    while self.schedule and (self.schedule[0][2] not in self.for_update or \
+                                             self.get_expiry(self.for_update[self.schedule[0][2]]) != self.schedule[0][0]):
+                        heapq.heappop(self.schedule)
+                    if not self.schedule:
+                        self.for_update_lock.wait()
+                        continue
+                    wait = self.schedule[0][0] - time.time()
+                    if wait > 0:
+                        self.for_update_lock.wait(wait)
+                        continue
+                    while self.schedule and self.schedule[0][0] <= time.time():
+                        (expiry, count, key) = heapq.heappop(self.schedule)
+                        if key in self.for_update and self.get_expiry(self.for_update[key]) == expiry:
+                            value = self.for_update.pop(key)
+                            self.patching[key] = value
+                            expired.append((key, count, value))
+            for (key, count, value) in expired:
+                self.patch_pool.submit((key, count), value)
+
+    def process_patch(self, value):
+        """
+        Patch worker target. The element is done when patch returns
+        """
+
+        try:
+            self.patch(value)
+        finally:
+            key = value['namespace'] + "/" + value['name']
+            with self.for_update_lock:
+                if self.patching.get(key) is value:
+                    del self.patching[key]
+
+    def patch(self, value):
+        """
+        Patch the controller with the new annotations
+        If there is no room in the rollout budget or the patch fails, put the element back
+        in the update dict to be retried later
+        """
+        self.log.debug("patch")
+
+        if self.is_up_to_date(value):
+            return
+        name = value['name']
+        namespace = value['namespace']
+        if not self.budget.acquire(namespace, name, value['kind']):
+            self.requeue(value, self.budget_retry_delay)
+            return
+        self.patch_limiter.acquire()
+        self.log.info("We will update %s", value['name'])
+        body = self.ann.build_annotation(value['changes'])
+        try:
+            patch_function = value['patch_func']
+            with metrics.api_timer('patch', value['kind']):
+                patch_function(name=name, namespace=namespace, body=body)
+            metrics.event_to_patch.observe(time.time() - value['event_time'])
+            update_function = value['update_function']
+            update_function(namespace=namespace, name=name, kind=value['kind'], changes=value['changes'])
+        except (ApiException, HTTPError, socket.error) as e:
+            # connection refused, timeouts and broken connections are retried like api errors
+            self.log.critical("Exception when calling patch_function: %s\n" % e)
+            self.budget.release(namespace, name, value['kind'])
+            if getattr(e, 'status', None) == 404 or value['retries'] >= self.patch_retries:
+                self.log.error("Giving up on %s %s/%s", value['kind'], namespace, name)
+                return
+            value['retries'] += 1
+            self.requeue(value, min(self.retry_delay * 2 ** value['retries'], self.max_retry_delay))
+        except BaseException:
+            # the slot would be held forever
+            self.budget.release(namespace, name, value['kind'])
+            raise
+
+    def requeue(self, value, delay):
+        """
+        Put the element back in the update dict, to expire after delay seconds
+        A newer element for the same controller takes our changes
+        """
+        self.log.debug("requeue %s in %ss", value['name'], delay)
+
+        key = value['namespace'] + "/" + value['name']
+        with self.for_update_lock:
+            if key in self.for_update:
+                changes = value['changes']
+                changes.update(self.for_update[key]['changes'])
+                self.for_update[key]['changes'] = changes
+                self.for_update[key]['event_time'] = min(self.for_update[key]['event_time'], value['event_time'])
+            else:
+                value['retry_at'] = time.time() + delay
+                self.add_for_update(key, value)
+
+    def get_checkpoint(self):
+        """
+        Return all elements that are not done, in a form that can be saved as json
+
+        Elements move from the queue to the waiting dict and then to the update dict.
+        We look at them in this order, so an element moving meanwhile is seen at least once.
+        The intake thread is never holding an element when we read the queue
+        """
+        self.log.debug("get_checkpoint")
+
+        while True:
+            with self.q.mutex:
+                items = list(self.q.queue)
+                if self.q.unfinished_tasks == len(items):
+                    break
+            time.sleep(0.01)
+        with self.waiting_lock:
+            items.extend(self.waiting.values())
+        with self.for_update_lock:
+            pending = [dict((k, v) for (k, v) in value.items() if k not in ('patch_func', 'update_function'))
+                       for value in self.patching.values() + self.for_update.values()]
+            for value in pending:
+                value['changes'] = dict(value['changes'])
+        restarts = [{'namespace': namespace, 'name': name, 'kind': kind, 'changes': changes}
+                    for (namespace, name, kind, changes) in self.restarter.get_jobs()]
+        return {'items': items, 'pending': pending, 'restarts': restarts}
+
+    def restore(self, checkpoint):
+        """
+        Load the elements from a checkpoint
+        Elements in the update dict keep their time, so they expire when they would have without a restart
+        """
+        self.log.info("Restoring %s items and %s updates", len(checkpoint['items']), len(checkpoint['pending']))
+
+        for item in checkpoint['items']:
+            self.q.put(item)
+        with self.for_update_lock:
+            for value in checkpoint['pending']:
+                key = value['namespace'] + "/" + value['name']
+                if key in self.for_update:
+                    self.for_update[key]['changes'].update(value['changes'])
+                    self.for_update[key]['event_time'] = min(self.for_update[key]['event_time'], value['event_time'])
+                    continue
+                (value['update_function'], value['patch_func']) = self.get_functions(value['kind'])
+                self.add_for_update(key, value)
+        for job in checkpoint.get('restarts', []):
+            self.restarter.restart(job['namespace'], job['name'], job['kind'], job['changes'])
+
+    def is_up_to_date(self, value):
+        """
+        Look in the workload cache before patching
+        Nothing to do if the controller was deleted or it already has all the versions
+        """
+        self.log.debug("is_up_to_date")
+
+        res = self.cache.get(value['namespace'], value['name'], value['kind'])
+        if res is None:
+            self.log.info("%s %s/%s does not exist anymore", value['kind'], value['namespace'], value['name'])
+            self.debouncer.forget(value['namespace'] + "/" + value['name'])
+            return True
+        annotations = res.spec.template.metadata.annotations or {}
+        for key_ann in value['changes']:
+            if str(annotations.get(key_ann)) != str(value['changes'][key_ann]):
+                return False
+        self.log.info("%s %s/%s is already up to date", value['kind'], value['namespace'], value['name'])
+        return True
+
+    def update_rollingupdate(self, namespace, name, kind, changes):
         """
         Nothing to do. Kubernetes will take care of everything
         """
         self.log.info("RollingUpdate resource %s:%s", kind, name)
 
-    def update_manually(self, namespace, name, kind):
+    def update_manually(self, namespace, name, kind, changes):
         """
-        Not implemented
+        Kubernetes doesn't replace the pods. The restarter deletes the old ones in batches
         """
-        self.log.info("Manually update resource")
+        self.log.info("Manually update resource %s:%s", kind, name)
 
-        return
-        self.get_pods_for_controller(namespace, name, kind)
+        self.restarter.restart(namespace, name, kind, changes)
 
     def get_pods_for_controller(self, namespace, name, kind):
         """
         In order to ensure that we do safe updates, we first ensure that all pods
         from the controller are ready
 
-        Deployments create a ReplicaSet that creates the pods
+        Pods are taken from the pod cache, indexed by their owner
         """
         self.log.info("Get pods for controller %s %s" % (kind, name))
 
-        if kind == 'Deployment':
-            res = self.v1b1e.list_namespaced_replica_set(namespace=namespace)
-            count = 0
-            reference_name = ''
-            for rs in res.items:
-                for owner_reference in rs.metadata.owner_references:
-                    if rs.status.replicas > 0 and owner_reference.kind == kind and owner_reference.name == name:
-                        self.log.info("Found ReplicaSet %s for %s:%s", rs.metadata.name, kind, name)
-                        reference_name = rs.metadata.name
-                        reference_kind = 'ReplicaSet'
-                        count += 1
-            if count > 1:
-                self.log.error("Too many (%s) ReplicaSets for %s:%s", count, kind, name)
-                return False
-        else:
-            # kind: 'DaemonSet', 'ReplicationController', 'StatefulSet'
-            reference_name = name
-            reference_kind = kind
-
-        pods_array = []
-        pods = self.v1.list_namespaced_pod(namespace=namespace)
-        for pod in pods.items:
-            if pod.metadata.annotations and 'kubernetes.io/created-by' in pod.metadata.annotations:
-                ann = json.loads(pod.metadata.annotations['kubernetes.io/created-by'])
-                ref = ann['reference']
-                if ref['name'] == reference_name and ref['kind'] == reference_kind:
-                    pods_array.append(pod)
-        return pods_array
+        return self.pod_cache.get_pods_for_controller(namespace, name, kind)
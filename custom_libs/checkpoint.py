@@ -0,0 +1,85 @@
+import logging, threading, time, json, os
+
+VERSION = 1
+
+class threadCheckpoint (threading.Thread):
+    def __init__(self, name, path, watchers, worker, interval=10):
+        """
+        Every interval seconds save the state of the watchers and of the worker in a file
+
+        watchers is a dict name -> threadWatchChanges, worker is the threadApplyChanges.
+        The file is written next to the old one and renamed, so it is never half written.
+        Both the file and the directory are synced, so a saved checkpoint survives a crash
+        """
+
+        threading.Thread.__init__(self)
+        self.log = logging.getLogger(__name__ + " " + name)
+        self.log.info("Init threadCheckpoint in %s", path)
+        self.path = path
+        self.watchers = watchers
+        self.worker = worker
+        self.interval = interval
+        self.save_lock = threading.Lock()
+
+    def run(self):
+        """
+        Save periodically
+        """
+        self.log.info("Starting thread")
+
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.save()
+            except BaseException as e:
+                self.log.exception('{!r}. Retrying.'.format(e))
+
+    def save(self):
+        """
+        Write the checkpoint. The watchers are read before the worker,
+        so a change sent by a watcher meanwhile is found in one of them
+        """
+        self.log.debug("save")
+
+        with self.save_lock:
+            start = time.time()
+            state = {
+                    'version': VERSION,
+                    'time': start,
+                    'watchers': dict((name, self.watchers[name].get_checkpoint()) for name in self.watchers),
+                    }
+            state['worker'] = self.worker.get_checkpoint()
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.path)
+            # the rename is only durable when the directory is written
+            fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.log.debug("Saved checkpoint in %.3fs", time.time() - start)
+
+def load(path):
+    """
+    Return the saved state or None if there is no usable checkpoint
+    """
+
+    log = logging.getLogger(__name__)
+    if not os.path.exists(path):
+        log.info("No checkpoint in %s", path)
+        return None
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        log.warning("Can't read checkpoint %s: %s", path, e)
+        return None
+    if state.get('version') != VERSION:
+        log.warning("Ignoring checkpoint %s with version %s", path, state.get('version'))
+        return None
+    log.info("Loaded checkpoint from %s saved %.0fs ago", path, time.time() - state['time'])
+    return state
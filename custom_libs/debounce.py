@@ -0,0 +1,50 @@
+import logging, threading
+
+class Debouncer():
+    def __init__(self, name, min_delay, max_delay, alpha=0.3):
+        """
+        Learn how changes of every controller come and decide how long to wait for more
+
+        We keep an average of the time between changes that come less than max_delay apart
+        (the changes of a burst). We wait twice that average, between min_delay and max_delay.
+        Controllers without recent bursts wait only min_delay.
+        Every isolated change makes us forget a part of the average
+        """
+
+        self.log = logging.getLogger(__name__ + " " + name)
+        self.log.info("Init Debouncer between %ss and %ss", min_delay, max_delay)
+        self.min_delay = float(min_delay)
+        self.max_delay = float(max_delay)
+        self.alpha = alpha
+        # key -> (time of the last change, average time between changes or None)
+        self.state = {}
+        self.lock = threading.Lock()
+
+    def observe(self, key, change_time):
+        """
+        Record a change and return how many seconds to wait for the next one
+        """
+
+        with self.lock:
+            (last, gap) = self.state.get(key, (None, None))
+            if last is not None and abs(change_time - last) < self.max_delay:
+                gap = abs(change_time - last) if gap is None else self.alpha * abs(change_time - last) + (1 - self.alpha) * gap
+            elif gap is not None:
+                gap = gap * (1 - self.alpha)
+                if gap < self.min_delay / 2:
+                    gap = None
+            self.state[key] = (change_time if last is None else max(change_time, last), gap)
+        if gap is None:
+            delay = self.min_delay
+        else:
+            delay = min(max(2 * gap, self.min_delay), self.max_delay)
+        self.log.debug("%s waits %.1fs for more changes", key, delay)
+        return delay
+
+    def forget(self, key):
+        """
+        Drop what we know about a deleted controller
+        """
+
+        with self.lock:
+            self.state.pop(key, None)
@@ -0,0 +1,58 @@
+import logging, threading, time, heapq, itertools
+
+class DelayQueue():
+    def __init__(self, name):
+        """
+        Queue where every item becomes available at its own deadline
+
+        Items are identified by a key. Putting an item with a key that is already waiting
+        replaces the item and keeps the earliest of the two deadlines
+
+        get blocks until the item with the earliest deadline is due
+        """
+
+        self.log = logging.getLogger(__name__ + " " + name)
+        self.log.info("Init DelayQueue")
+        self.heap = []
+        self.items = {}
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+
+    def put(self, key, item, delay=0):
+        """
+        Add the item. It will be returned by get after delay seconds
+        """
+        self.log.debug("put %s in %ss", key, delay)
+
+        deadline = time.time() + delay
+        with self.cond:
+            if key in self.items and self.items[key][0] <= deadline:
+                self.items[key] = (self.items[key][0], item)
+                return
+            self.items[key] = (deadline, item)
+            heapq.heappush(self.heap, (deadline, next(self.counter), key))
+            self.cond.notify()
+
+    def get(self):
+        """
+        Wait for the earliest item to be due and return (key, item)
+        """
+
+        with self.cond:
+            while True:
+                # drop heap entries for items that were replaced or already returned
+                while self.heap and (self.heap[0][2] not in self.items or self.items[self.heap[0][2]][0] != self.heap[0][0]):
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                wait = self.heap[0][0] - time.time()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                (deadline, count, key) = heapq.heappop(self.heap)
+                return (key, self.items.pop(key)[1])
+
+    def __len__(self):
+        with self.cond:
+            return len(self.items)
@@ -0,0 +1,89 @@
+import logging, threading, hashlib
+from custom_libs import metrics
+
+class DigestCache():
+    def __init__(self):
+        """
+        Compute the digest of the content of configmaps/secrets
+
+        The digest is used as the version of the config instead of the resourceVersion,
+        so changes in labels/annotations or re-applying the same content don't restart pods
+
+        For every config we remember the hash of every key for its last resourceVersion.
+        The digests of all sets of keys are made from them, so an object is read and hashed only once
+        """
+
+        self.log = logging.getLogger(__name__)
+        self.log.info("Init DigestCache")
+        # (namespace, kind, name) -> (resource versions, {(field, key): hash of the value})
+        self.hashes = {}
+        self.hashes_lock = threading.Lock()
+
+    def get_digest(self, obj, keys=None, read_func=None):
+        """
+        Return the digest of data/binaryData/stringData of the object
+        If keys is not None only those keys are used
+
+        When we only watch the metadata, read_func(name, namespace) returns the full object.
+        It is called only if the hashes of this version are not known yet
+        """
+        self.log.debug("get_digest %s %s/%s", obj.kind, obj.metadata.namespace, obj.metadata.name)
+
+        key_obj = (obj.metadata.namespace, obj.kind, obj.metadata.name)
+        with self.hashes_lock:
+            (versions, hashes) = self.hashes.get(key_obj, ((), None))
+        if obj.metadata.resource_version not in versions:
+            versions = set([obj.metadata.resource_version])
+            if read_func is not None:
+                with metrics.api_timer('get', obj.kind):
+                    full_obj = read_func(obj.metadata.name, obj.metadata.namespace)
+                if full_obj.metadata.resource_version != obj.metadata.resource_version:
+                    # changed again since the event. We use the newest content,
+                    # the next event gets the same digest
+                    self.log.debug("%s %s/%s is at version %s", obj.kind, obj.metadata.namespace, obj.metadata.name, full_obj.metadata.resource_version)
+                    versions.add(full_obj.metadata.resource_version)
+                obj = full_obj
+            hashes = get_hashes(obj)
+            with self.hashes_lock:
+                self.hashes[key_obj] = (versions, hashes)
+        return combine_hashes(hashes, keys)
+
+    def forget(self, namespace, kind, name):
+        """
+        Drop the hashes of a deleted config
+        """
+        self.log.debug("forget %s %s/%s", kind, namespace, name)
+
+        with self.hashes_lock:
+            self.hashes.pop((namespace, kind, name), None)
+
+def get_hashes(obj):
+    """
+    sha256 of every value of all data fields
+    """
+
+    hashes = {}
+    for field in ('data', 'binary_data', 'string_data'):
+        data = getattr(obj, field, None) or {}
+        for key in data:
+            hashes[(field, key)] = hashlib.sha256(data[key].encode('utf8')).digest()
+    return hashes
+
+def combine_hashes(hashes, keys=None):
+    """
+    sha256 over the sorted keys and the hashes of their values
+    """
+
+    sha = hashlib.sha256()
+    for (field, key) in sorted(hashes):
+        if keys is not None and key not in keys:
+            continue
+        sha.update(field.encode('utf8') + b'\0' + key.encode('utf8') + b'\0' + hashes[(field, key)])
+    return 'sha256-' + sha.hexdigest()
+
+def compute_digest(obj, keys=None):
+    """
+    Digest of the object, the same that DigestCache returns
+    """
+
+    return combine_hashes(get_hashes(obj), keys)
@@ -0,0 +1,235 @@
+import logging, threading, time
+from kubernetes.client.rest import ApiException
+from custom_libs import metrics, apiclient
+
+class threadInformer (threading.Thread):
+    def __init__(self, name, list_func, kind, handler=None, keep_objects=True, shards=None, watch_timeout=300,
+                 namespace=None, label_selector=None, field_selector=None, page_size=None):
+        """
+        Keep a local copy of all objects returned by list_func
+
+        We list everything once, then watch from the resourceVersion of the list
+        and apply ADDED/MODIFIED/DELETED events on the local store.
+        Readers should use get/list instead of calling the api
+
+        handler is called with (event_type, obj, old_obj) after the store is updated
+
+        If keep_objects is False we only remember the resourceVersion of every object.
+        This is enough to resume watches and to find what changed after a new list
+
+        With shards, objects from namespaces owned by other replicas are ignored.
+        When the namespaces are redistributed we list everything again and synced is
+        cleared until the new list is done.
+        Watches are restarted every watch_timeout seconds, so a new list is never delayed more than that
+
+        With a namespace, list_func must be a namespaced list function and is called with it.
+        label_selector and field_selector are sent to the api, so filtered objects are never received
+
+        Lists are done in pages of page_size objects (by default apiclient.page_size),
+        so a big list is never held in memory at once
+
+        We need to send "kind" because of https://github.com/kubernetes-client/python/issues/429
+        (we don't know what kind of resource we have on return)
+        """
+
+        threading.Thread.__init__(self)
+        self.log = logging.getLogger(__name__ + " " + name)
+        self.log.info("Init threadInformer")
+        self.list_func = list_func
+        self.kind = kind
+        self.handler = handler
+        self.keep_objects = keep_objects
+        self.store = {}
+        self.versions = {}
+        self.store_lock = threading.Lock()
+        self.shards = shards
+        self.watch_timeout = watch_timeout
+        self.page_size = page_size
+        # a Watch can only stream once at a time, so every informer has one
+        self.w = apiclient.SharedWatch()
+        self.list_args = [namespace] if namespace else []
+        self.list_kwargs = {}
+        if label_selector:
+            self.list_kwargs['label_selector'] = label_selector
+        if field_selector:
+            self.list_kwargs['field_selector'] = field_selector
+        self.resource_version = None
+        self.resync_requested = False
+        self.synced = threading.Event()
+        # ring of the last list, namespaces that we got after it are not listed yet
+        self.listed_ring = None
+        if shards:
+            self.listed_ring = shards.get_ring()
+            shards.on_rebalance(self.resync)
+
+    def run(self):
+        """
+        List all objects, then watch for changes
+
+        When the watch ends we resume from the last resourceVersion that we have seen.
+        We list everything again only when the api tells us that our version is too old (410 Gone)
+        """
+        self.log.info("Starting thread")
+
+        while True:
+            try:
+                if self.resource_version is None or self.resync_requested:
+                    self.resync_requested = False
+                    try:
+                        self.relist()
+                    except BaseException:
+                        # list again on the next loop, not only watch
+                        self.resource_version = None
+                        raise
+                self.watch()
+            except ApiException as e:
+                if e.status == 410:
+                    self.log.info("resourceVersion %s is too old. Listing again.", self.resource_version)
+                    self.resource_version = None
+                else:
+                    metrics.api_errors.labels('watch', self.kind).inc()
+                    self.log.exception('{!r}. Restarting loop.'.format(e))
+                    time.sleep(1)
+            except BaseException as e:
+                self.log.exception('{!r}. Restarting loop.'.format(e))
+                time.sleep(1)
+        self.log.info("Thread has been stopped")
+
+    def relist(self):
+        """
+        List everything again and compare with the versions that we know
+        Only new, changed and deleted objects are sent to the handler
+        """
+        self.log.info("List all %s", self.kind)
+
+        seen = set()
+        resource_version = None
+        if self.shards:
+            self.listed_ring = self.shards.get_ring()
+        page_size = self.page_size if self.page_size is not None else apiclient.page_size
+        for res in apiclient.list_pages(self.list_func, self.kind, page_size, *self.list_args, **self.list_kwargs):
+            resource_version = resource_version or res.metadata.resource_version
+            for obj in res.items:
+                if not self.is_owned(obj):
+                    continue
+                # list items don't have the kind set
+                obj.kind = self.kind
+                key = self.get_key(obj)
+                seen.add(key)
+                with self.store_lock:
+                    version = self.versions.get(key)
+                if version is None:
+                    self.apply('ADDED', obj)
+                elif version != obj.metadata.resource_version:
+                    self.apply('MODIFIED', obj)
+        with self.store_lock:
+            gone = [key for key in self.versions if key not in seen]
+        for key in gone:
+            self.delete(key)
+        self.resource_version = resource_version
+        # a resync requested meanwhile needs another list
+        if not self.resync_requested:
+            self.synced.set()
+        self.log.info("Listed %s %s at version %s", len(seen), self.kind, self.resource_version)
+
+    def watch(self):
+        """
+        Apply all events on the store, starting from the last known resourceVersion
+        """
+        self.log.debug("watch")
+
+        w = self.w
+        for event in w.stream(self.list_func, *self.list_args, resource_version=self.resource_version,
+                              timeout_seconds=self.watch_timeout, _request_timeout=0, **self.list_kwargs):
+            if event['type'] == 'ERROR':
+                status = event['raw_object']
+                raise ApiException(status=status.get('code'), reason=status.get('message'))
+            if self.resync_requested:
+                # the new list will have this change
+                w.stop()
+                return
+            obj = event['object']
+            # metadata only objects are sent as PartialObjectMetadata
+            obj.kind = self.kind
+            if self.is_owned(obj):
+                self.apply(event['type'], obj)
+            self.resource_version = obj.metadata.resource_version
+
+    def apply(self, event_type, obj):
+        """
+        Update the store and call the handler
+        """
+        self.log.debug("Event: %s %s %s/%s %s" % (event_type, self.kind, obj.metadata.namespace, obj.metadata.name, obj.metadata.resource_version))
+
+        metrics.watch_events.labels(self.kind, event_type).inc()
+        key = self.get_key(obj)
+        with self.store_lock:
+            old = self.store.get(key)
+            if event_type == 'DELETED':
+                self.store.pop(key, None)
+                self.versions.pop(key, None)
+            else:
+                if self.keep_objects:
+                    self.store[key] = obj
+                self.versions[key] = obj.metadata.resource_version
+        if self.handler:
+            self.handler(event_type, obj, old)
+
+    def delete(self, key):
+        """
+        The object was not found on a new list. We don't have a DELETED event for it
+        If we don't keep objects the handler is not called
+        """
+        self.log.debug("delete %s", key)
+
+        with self.store_lock:
+            old = self.store.pop(key, None)
+            self.versions.pop(key, None)
+        if old is not None and self.handler:
+            self.handler('DELETED', old, old)
+
+    def resync(self):
+        """
+        List everything again after the current watch ends
+        We are not synced until that list is done
+        """
+        self.log.info("Resync requested")
+
+        self.synced.clear()
+        self.resync_requested = True
+
+    def is_owned(self, obj):
+        """
+        Check if the namespace of the object belongs to this replica, now and at the last list
+
+        A namespace that we just got is ignored until we list it, so its objects are found
+        by the new list even if the watch saw them first
+        """
+
+        if self.shards is None:
+            return True
+        namespace = obj.metadata.namespace
+        return self.shards.owns(namespace) and self.shards.owns(namespace, self.listed_ring)
+
+    def get_key(self, obj):
+        """
+        Objects are identified by namespace/name
+        """
+
+        return obj.metadata.namespace + "/" + obj.metadata.name
+
+    def get(self, key):
+        """
+        Return the object with the respective key or None
+        """
+
+        with self.store_lock:
+            return self.store.get(key)
+
+    def list(self, namespace=None):
+        """
+        Return all objects, optionally only from one namespace
+        """
+
+        with self.store_lock:
+            return [obj for obj in self.store.values() if namespace is None or obj.metadata.namespace == namespace]
@@ -0,0 +1,58 @@
+import logging
+from custom_libs import apiclient
+
+# kind -> (path of the resource, model used to deserialize the items)
+RESOURCES = {
+        'ConfigMap': ('/api/v1', 'configmaps', 'V1ConfigMap'),
+        'Secret': ('/api/v1', 'secrets', 'V1Secret'),
+        }
+
+# Servers that don't know PartialObjectMetadata send the full objects
+ACCEPT_LIST = 'application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=v1,application/json'
+ACCEPT_WATCH = 'application/json;as=PartialObjectMetadata;g=meta.k8s.io;v=v1,application/json'
+
+QUERY_PARAMS = {
+        'label_selector': 'labelSelector',
+        'field_selector': 'fieldSelector',
+        'resource_version': 'resourceVersion',
+        'timeout_seconds': 'timeoutSeconds',
+        'limit': 'limit',
+        '_continue': 'continue',
+        'watch': 'watch',
+        }
+
+class MetadataLister():
+    def __init__(self, kind, api_client=None):
+        """
+        List and watch only the metadata of configmaps/secrets
+
+        Can be used instead of list_config_map_for_all_namespaces/list_namespaced_config_map
+        (and the same for secrets): called without a namespace it lists all namespaces.
+        The api server strips everything except metadata, so data is never sent to us.
+        Items are returned as V1ConfigMap/V1Secret with only metadata set
+
+        The client version we use doesn't know about PartialObjectMetadata, so we call the api directly
+        """
+
+        self.log = logging.getLogger(__name__ + " " + kind)
+        self.kind = kind
+        (self.prefix, self.plural, self.model) = RESOURCES[kind]
+        self.api_client = api_client or apiclient.get_api_client()
+        # watch.Watch finds the type of the objects in the docstring
+        self.__doc__ = ":return: %sList" % self.model
+
+    def __call__(self, namespace=None, **kwargs):
+        """
+        Same parameters as the generated list functions
+        """
+        self.log.debug("list %s %s", namespace, kwargs)
+
+        path = self.prefix + ('/namespaces/{namespace}' if namespace else '') + '/' + self.plural
+        path_params = {'namespace': namespace} if namespace else {}
+        query_params = [(QUERY_PARAMS[key], kwargs[key]) for key in QUERY_PARAMS if kwargs.get(key) is not None]
+        accept = ACCEPT_WATCH if kwargs.get('watch') else ACCEPT_LIST
+        return self.api_client.call_api(path, 'GET', path_params, query_params, {'Accept': accept},
+                                        response_type=self.model + 'List', auth_settings=['BearerToken'],
+                                        _return_http_data_only=True,
+                                        _preload_content=kwargs.get('_preload_content', True),
+                                        _request_timeout=kwargs.get('_request_timeout'))
@@ -0,0 +1,88 @@
+import logging, threading, time
+from contextlib import contextmanager
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+class NoopMetric():
+    """
+    Used when prometheus_client is not installed. Accepts all calls and does nothing
+    """
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, *args, **kwargs):
+        pass
+
+    def set(self, *args, **kwargs):
+        pass
+
+    def set_function(self, *args, **kwargs):
+        pass
+
+    def observe(self, *args, **kwargs):
+        pass
+
+def metric(metric_type, name, documentation, labelnames=(), **kwargs):
+    """
+    Create the prometheus metric or a no-op one
+    """
+
+    if prometheus_client is None:
+        return NoopMetric()
+    return getattr(prometheus_client, metric_type)(name, documentation, labelnames, **kwargs)
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+ROLLOUT_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 3600)
+
+watch_events = metric('Counter', 'updateresources_watch_events_total',
+                      'Watch events received', ['resource', 'type'])
+queue_depth = metric('Gauge', 'updateresources_queue_depth',
+                     'Elements waiting in a queue', ['queue'])
+event_to_patch = metric('Histogram', 'updateresources_event_to_patch_seconds',
+                        'Time from the config event to the controller patch', buckets=ROLLOUT_BUCKETS)
+debounce = metric('Histogram', 'updateresources_debounce_seconds',
+                  'Time a controller waits for more changes before it is patched', buckets=ROLLOUT_BUCKETS)
+should_update_duration = metric('Histogram', 'updateresources_should_update_seconds',
+                                'Duration of the readiness check of a controller', buckets=LATENCY_BUCKETS)
+api_duration = metric('Histogram', 'updateresources_api_request_seconds',
+                      'Duration of apiserver calls', ['verb', 'resource'], buckets=LATENCY_BUCKETS)
+api_errors = metric('Counter', 'updateresources_api_errors_total',
+                    'Failed apiserver calls', ['verb', 'resource'])
+restarted_pods = metric('Counter', 'updateresources_restarted_pods_total',
+                        'Pods deleted to restart them with a new template', ['kind'])
+workers = metric('Gauge', 'updateresources_workers',
+                 'Worker threads of a pool', ['pool'])
+threads = metric('Gauge', 'updateresources_threads',
+                 'Running threads')
+threads.set_function(threading.active_count)
+
+@contextmanager
+def api_timer(verb, resource):
+    """
+    Measure an apiserver call and count it as an error if it raises
+    """
+
+    start = time.time()
+    try:
+        yield
+    except BaseException:
+        api_errors.labels(verb, resource).inc()
+        raise
+    finally:
+        api_duration.labels(verb, resource).observe(time.time() - start)
+
+def start_server(port):
+    """
+    Serve /metrics on the port
+    """
+    log = logging.getLogger(__name__)
+
+    if prometheus_client is None:
+        log.warning("prometheus_client is not installed. Metrics are disabled")
+        return
+    log.info("Serving metrics on port %s", port)
+    prometheus_client.start_http_server(port)
@@ -0,0 +1,116 @@
+import logging, threading, json, functools
+from kubernetes import client
+from custom_libs import informer, apiclient
+
+class PodCache():
+    def __init__(self, shards=None):
+        """
+        Shared local copy of all pods and ReplicaSets, indexed by their owner
+
+        Owners are taken from metadata.ownerReferences. For old clusters that don't
+        set them we fall back to the kubernetes.io/created-by annotation
+
+        Deployments create a ReplicaSet that creates the pods
+
+        With shards, we only keep the objects from namespaces owned by this replica
+        """
+
+        self.log = logging.getLogger(__name__)
+        self.log.info("Init PodCache")
+        self.v1 = client.CoreV1Api(apiclient.get_api_client())
+        self.v1b1e = client.ExtensionsV1beta1Api(apiclient.get_api_client())
+        # (namespace, owner_kind, owner_name) -> set of keys
+        self.owners = {}
+        self.owners_lock = threading.Lock()
+        self.informers = {
+                'Pod': informer.threadInformer("pods", self.v1.list_pod_for_all_namespaces, 'Pod',
+                                              functools.partial(self.apply, 'Pod'), shards=shards),
+                'ReplicaSet': informer.threadInformer("replicasets", self.v1b1e.list_replica_set_for_all_namespaces, 'ReplicaSet',
+                                                     functools.partial(self.apply, 'ReplicaSet'), shards=shards),
+                }
+
+    def start(self):
+        """
+        Start all informers
+        """
+        self.log.info("Starting informers")
+
+        for kind in self.informers:
+            self.informers[kind].daemon = True
+            self.informers[kind].start()
+
+    def wait_for_sync(self, timeout=None):
+        """
+        Block until every informer did the initial list
+        """
+        self.log.info("Waiting for informers to sync")
+
+        for kind in self.informers:
+            if not self.informers[kind].synced.wait(timeout):
+                return False
+        return True
+
+    def apply(self, kind, event_type, obj, old):
+        """
+        Informer handler. Move the object from the old owners to the new ones
+        """
+        self.log.debug("apply %s %s/%s" % (event_type, obj.metadata.namespace, obj.metadata.name))
+
+        key = (kind, obj.metadata.name)
+        with self.owners_lock:
+            if old is not None:
+                for owner in get_owners(old):
+                    keys = self.owners.get((old.metadata.namespace,) + owner)
+                    if keys is not None:
+                        keys.discard(key)
+                        if not keys:
+                            del self.owners[(old.metadata.namespace,) + owner]
+            if event_type != 'DELETED':
+                for owner in get_owners(obj):
+                    self.owners.setdefault((obj.metadata.namespace,) + owner, set()).add(key)
+
+    def get_owned(self, namespace, owner_kind, owner_name, kind):
+        """
+        Return all objects of the respective kind (Pod or ReplicaSet) owned by the owner
+        """
+        self.log.debug("get_owned %s %s %s/%s", kind, owner_kind, namespace, owner_name)
+
+        with self.owners_lock:
+            names = [key[1] for key in self.owners.get((namespace, owner_kind, owner_name), ()) if key[0] == kind]
+        owned = []
+        for name in names:
+            obj = self.informers[kind].get(namespace + "/" + name)
+            if obj is not None:
+                owned.append(obj)
+        return owned
+
+    def get_pods_for_controller(self, namespace, name, kind):
+        """
+        Return the pods of the controller
+        For Deployments we return the pods of the ReplicaSet that has replicas.
+        If there is more than one, a rollout is in progress and we return False
+        """
+        self.log.debug("get_pods_for_controller %s %s/%s", kind, namespace, name)
+
+        if kind == 'Deployment':
+            replica_sets = [rs for rs in self.get_owned(namespace, kind, name, 'ReplicaSet') if rs.status.replicas > 0]
+            if len(replica_sets) > 1:
+                self.log.error("Too many (%s) ReplicaSets for %s:%s", len(replica_sets), kind, name)
+                return False
+            if not replica_sets:
+                return []
+            kind = 'ReplicaSet'
+            name = replica_sets[0].metadata.name
+        return self.get_owned(namespace, kind, name, 'Pod')
+
+def get_owners(obj):
+    """
+    Return a list of (kind, name) of the owners of the object
+    """
+
+    if obj.metadata.owner_references:
+        return [(owner.kind, owner.name) for owner in obj.metadata.owner_references]
+    if obj.metadata.annotations and 'kubernetes.io/created-by' in obj.metadata.annotations:
+        ref = json.loads(obj.metadata.annotations['kubernetes.io/created-by'])['reference']
+        return [(ref['kind'], ref['name'])]
+    return []
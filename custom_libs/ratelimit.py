@@ -0,0 +1,45 @@
+import logging, threading, time
+
+class TokenBucket():
+    def __init__(self, name, rate, burst=1):
+        """
+        Allow rate operations per second, with bursts of up to burst operations
+        A rate of 0 means no limit
+        """
+
+        self.log = logging.getLogger(__name__ + " " + name)
+        self.log.info("Init TokenBucket with rate %s and burst %s", rate, burst)
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """
+        Take a token if one is available
+        Return 0 on success, otherwise the number of seconds until a token is available
+        """
+
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Block until a token is available and take it
+        """
+
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            self.log.debug("Rate limited. Waiting %ss", wait)
+            time.sleep(wait)
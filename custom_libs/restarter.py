@@ -0,0 +1,202 @@
+import logging, threading, time
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from custom_libs import annotations, apiclient, metrics
+
+class threadRestarter (threading.Thread):
+    def __init__(self, name, cache, pod_cache, max_unavailable='25%', interval=5, progress_timeout=600):
+        """
+        Restart the pods of ReplicationControllers and StatefulSets after their template was patched
+
+        Kubernetes doesn't roll them: ReplicationControllers never replace running pods and
+        StatefulSets with the OnDelete strategy wait for someone to delete the pods.
+        StatefulSets with the RollingUpdate strategy are rolled by kubernetes, respecting their partition,
+        so we leave them alone
+
+        A pod is outdated if it doesn't have the annotations that we patched on the template.
+        Every interval seconds, for every controller, we delete outdated pods as long as at most
+        max_unavailable pods are not ready. Deleted pods are not ready until the controller replaced them
+        and the new pods are ready, so every batch waits for the previous one.
+        max_unavailable is a number or a percentage of the replicas, rounded down but at least 1.
+        The annotation opsguru.signature/max-unavailable of a controller replaces it
+
+        StatefulSets are restarted from the highest ordinal down. Pods with an ordinal below
+        the opsguru.signature/partition annotation are not restarted.
+        With podManagementPolicy OrderedReady only one pod is restarted at a time
+
+        If the pods are not ready progress_timeout seconds after the last batch, we give up on the controller
+        """
+
+        threading.Thread.__init__(self)
+        self.log = logging.getLogger(__name__ + " " + name)
+        self.log.info("Init threadRestarter with max unavailable %s", max_unavailable)
+        self.cache = cache
+        self.pod_cache = pod_cache
+        self.max_unavailable = str(max_unavailable)
+        self.interval = interval
+        self.progress_timeout = progress_timeout
+        self.v1 = client.CoreV1Api(apiclient.get_api_client())
+        self.ann = annotations.Annotations()
+        # (namespace, kind, name) -> {'changes': annotations of the template, 'progress': time of the last batch,
+        #                             'deleted': uids of the pods that we deleted}
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        metrics.queue_depth.labels('restarts').set_function(lambda: len(self.jobs))
+
+    def restart(self, namespace, name, kind, changes):
+        """
+        Restart the pods of the controller that don't have the changes yet
+        The changes of a restart in progress are kept, the new ones win
+        """
+        self.log.info("Restart %s %s/%s", kind, namespace, name)
+
+        with self.jobs_lock:
+            job = self.jobs.setdefault((namespace, kind, name), {'changes': {}, 'deleted': set()})
+            job['changes'].update(changes)
+            job['progress'] = time.time()
+
+    def is_restarting(self, namespace, name, kind):
+        """
+        Check if we are still restarting pods of the controller
+        """
+
+        with self.jobs_lock:
+            return (namespace, kind, name) in self.jobs
+
+    def get_jobs(self):
+        """
+        Return the restarts in progress as (namespace, name, kind, changes)
+        """
+
+        with self.jobs_lock:
+            return [(key[0], key[2], key[1], dict(job['changes'])) for (key, job) in self.jobs.items()]
+
+    def run(self):
+        """
+        Start a batch for every controller that has room for it
+        """
+        self.log.info("Starting thread")
+
+        while True:
+            with self.jobs_lock:
+                jobs = self.jobs.items()
+            for (key, job) in jobs:
+                try:
+                    if self.restart_batch(key, job):
+                        with self.jobs_lock:
+                            if self.jobs.get(key) is job:
+                                del self.jobs[key]
+                except BaseException as e:
+                    self.log.exception('{!r}. Continue with next controller.'.format(e))
+            time.sleep(self.interval)
+
+    def restart_batch(self, key, job):
+        """
+        Delete as many outdated pods as the unavailable pods allow
+        Return True when all pods are new and ready
+        """
+        (namespace, kind, name) = key
+        self.log.debug("restart_batch %s %s/%s", kind, namespace, name)
+
+        res = self.cache.get(namespace, name, kind)
+        if res is None:
+            self.log.info("%s %s/%s does not exist anymore", kind, namespace, name)
+            return True
+        if kind == 'StatefulSet' and res.spec.update_strategy and res.spec.update_strategy.type == 'RollingUpdate':
+            self.log.info("%s %s/%s is rolled by kubernetes", kind, namespace, name)
+            return True
+        pods = self.pod_cache.get_pods_for_controller(namespace, name, kind) or []
+        with self.jobs_lock:
+            changes = dict(job['changes'])
+        # the pod cache may not have seen our last deletes yet
+        job['deleted'] &= set(pod.metadata.uid for pod in pods)
+        pods = [pod for pod in pods if pod.metadata.deletion_timestamp is None and pod.metadata.uid not in job['deleted']]
+        outdated = [pod for pod in pods if self.is_outdated(pod, changes)]
+        max_unavailable = self.get_max_unavailable(res)
+        if kind == 'StatefulSet':
+            partition = self.ann.get_number(res, self.ann.opsguru_partition) or 0
+            outdated = sorted([pod for pod in outdated if get_ordinal(pod) >= partition], key=get_ordinal, reverse=True)
+            if (res.spec.pod_management_policy or 'OrderedReady') == 'OrderedReady':
+                max_unavailable = 1
+        replicas = res.spec.replicas if res.spec.replicas is not None else 1
+        ready = len([pod for pod in pods if is_ready(pod)])
+        if not outdated and ready >= replicas:
+            self.log.info("All pods of %s %s/%s are restarted", kind, namespace, name)
+            return True
+
+        allowed = max_unavailable - max(replicas - ready, 0)
+        if not outdated or allowed <= 0:
+            if time.time() - job['progress'] > self.progress_timeout:
+                self.log.error("Giving up restarting %s %s/%s. %s of %s pods are ready", kind, namespace, name, ready, replicas)
+                return True
+            self.log.info("Waiting for pods of %s %s/%s. %s of %s are ready", kind, namespace, name, ready, replicas)
+            return False
+
+        self.log.info("Restarting %s of %s outdated pods of %s %s/%s", min(allowed, len(outdated)), len(outdated), kind, namespace, name)
+        for pod in outdated[:allowed]:
+            self.delete_pod(pod, kind)
+            job['deleted'].add(pod.metadata.uid)
+        job['progress'] = time.time()
+        return False
+
+    def is_outdated(self, pod, changes):
+        """
+        Check if the pod was created before the template had the changes
+        """
+
+        pod_annotations = pod.metadata.annotations or {}
+        for key_ann in changes:
+            if str(pod_annotations.get(key_ann)) != str(changes[key_ann]):
+                return True
+        return False
+
+    def get_max_unavailable(self, res):
+        """
+        Return how many pods of the controller can be unavailable, at least 1
+        """
+
+        value = (res.metadata.annotations or {}).get(self.ann.opsguru_max_unavailable, self.max_unavailable)
+        replicas = res.spec.replicas if res.spec.replicas is not None else 1
+        try:
+            if value.endswith('%'):
+                return max(int(replicas * float(value[:-1]) / 100), 1)
+            return max(int(value), 1)
+        except ValueError:
+            self.log.warning("Invalid max unavailable on %s/%s: %s", res.metadata.namespace, res.metadata.name, value)
+            return 1
+
+    def delete_pod(self, pod, kind):
+        """
+        Delete the pod, the controller creates a new one from the new template
+        """
+        self.log.info("Delete pod %s/%s", pod.metadata.namespace, pod.metadata.name)
+
+        try:
+            with metrics.api_timer('delete', 'Pod'):
+                self.v1.delete_namespaced_pod(pod.metadata.name, pod.metadata.namespace, client.V1DeleteOptions())
+            metrics.restarted_pods.labels(kind).inc()
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+def get_ordinal(pod):
+    """
+    Pods of StatefulSets are named <statefulset>-<ordinal>
+    """
+
+    try:
+        return int(pod.metadata.name.rsplit('-', 1)[1])
+    except (IndexError, ValueError):
+        return -1
+
+def is_ready(pod):
+    """
+    Check the Ready condition of the pod. Without conditions a running pod is ready
+    """
+
+    if pod.status is None:
+        return False
+    for condition in pod.status.conditions or []:
+        if condition.type == 'Ready':
+            return condition.status == 'True'
+    return pod.status.phase == 'Running'
@@ -0,0 +1,128 @@
+import logging, threading, time
+from custom_libs import annotations
+
+class RolloutBudget():
+    def __init__(self, cache, max_rollouts=0, max_rollouts_per_namespace=0, restarter=None, progress_timeout=600):
+        """
+        Limit how many controllers we roll at the same time, globally and per namespace
+        A limit of 0 means no limit
+
+        A controller is in progress from the moment we patch it until the workload cache
+        shows a newer generation that was observed and fully rolled out.
+        Controllers whose pods are restarted by the restarter are in progress until it's done.
+        After progress_timeout seconds we stop waiting for a controller, its rollout is stuck
+
+        Kubernetes doesn't roll DaemonSets with the OnDelete strategy and paused Deployments,
+        so they never count
+        """
+
+        self.log = logging.getLogger(__name__)
+        self.log.info("Init RolloutBudget with %s global and %s per namespace", max_rollouts, max_rollouts_per_namespace)
+        self.cache = cache
+        self.max_rollouts = max_rollouts
+        self.max_rollouts_per_namespace = max_rollouts_per_namespace
+        self.restarter = restarter
+        self.progress_timeout = progress_timeout
+        self.ann = annotations.Annotations()
+        # (namespace, kind, name) -> (generation before our patch, time of the patch)
+        self.in_progress = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, namespace, name, kind):
+        """
+        Return True and count the controller as in progress if we have room for it
+        """
+        self.log.debug("acquire %s %s/%s", kind, namespace, name)
+
+        if not self.max_rollouts and not self.max_rollouts_per_namespace:
+            return True
+        res = self.cache.get(namespace, name, kind)
+        if res is not None and not is_rolled(res, kind):
+            self.log.debug("%s %s/%s is not rolled by kubernetes", kind, namespace, name)
+            return True
+        with self.lock:
+            self.prune()
+            if self.max_rollouts and len(self.in_progress) >= self.max_rollouts:
+                self.log.info("Too many rollouts in progress (%s). %s %s/%s waits", len(self.in_progress), kind, namespace, name)
+                return False
+            in_namespace = len([key for key in self.in_progress if key[0] == namespace])
+            if self.max_rollouts_per_namespace and in_namespace >= self.max_rollouts_per_namespace:
+                self.log.info("Too many rollouts in progress in %s (%s). %s %s waits", namespace, in_namespace, kind, name)
+                return False
+            generation = res.metadata.generation if res is not None else 0
+            self.in_progress[(namespace, kind, name)] = (generation, time.time())
+            return True
+
+    def release(self, namespace, name, kind):
+        """
+        The patch failed, so the controller is not rolling
+        """
+        self.log.debug("release %s %s/%s", kind, namespace, name)
+
+        with self.lock:
+            self.in_progress.pop((namespace, kind, name), None)
+
+    def prune(self):
+        """
+        Forget the controllers that finished rolling, were deleted or are stuck
+        Must be called with the lock held
+        """
+
+        for key in list(self.in_progress):
+            (namespace, kind, name) = key
+            if self.restarter and self.restarter.is_restarting(namespace, name, kind):
+                continue
+            (generation, start) = self.in_progress[key]
+            res = self.cache.get(namespace, name, kind)
+            if res is None or not is_rolled(res, kind) or \
+               (res.metadata.generation > generation and not is_rolling_out(res, kind, self.get_partition(res, kind))):
+                self.log.debug("Rollout finished for %s %s/%s", kind, namespace, name)
+                del self.in_progress[key]
+            elif time.time() - start > self.progress_timeout:
+                self.log.warning("Rollout of %s %s/%s did not finish in %ss", kind, namespace, name, self.progress_timeout)
+                del self.in_progress[key]
+
+    def get_partition(self, res, kind):
+        """
+        Pods of a StatefulSet with an ordinal below the partition are not updated.
+        Kubernetes uses the partition of the RollingUpdate strategy, the restarter our annotation
+        """
+
+        if kind != 'StatefulSet':
+            return 0
+        strategy = res.spec.update_strategy
+        if strategy and strategy.type == 'RollingUpdate':
+            return (strategy.rolling_update.partition if strategy.rolling_update else None) or 0
+        return int(self.ann.get_number(res, self.ann.opsguru_partition) or 0)
+
+def is_rolled(res, kind):
+    """
+    Check if kubernetes or the restarter rolls the pods after the template changed
+    DaemonSets from extensions/v1beta1 are OnDelete by default
+    """
+
+    if kind == 'DaemonSet':
+        return res.spec.update_strategy is not None and res.spec.update_strategy.type == 'RollingUpdate'
+    if kind == 'Deployment':
+        return not res.spec.paused
+    return True
+
+def is_rolling_out(res, kind, partition=0):
+    """
+    Check the rollout status of the controller
+    """
+
+    status = res.status
+    if status is None or (status.observed_generation or 0) < res.metadata.generation:
+        return True
+    if kind == 'DaemonSet':
+        desired = status.desired_number_scheduled or 0
+        return (status.updated_number_scheduled or 0) < desired or (status.number_available or 0) < desired
+    replicas = res.spec.replicas if res.spec.replicas is not None else 1
+    if kind == 'Deployment':
+        return (status.updated_replicas or 0) < replicas or (status.available_replicas or 0) < replicas or \
+               (status.replicas or 0) > replicas
+    if kind == 'StatefulSet':
+        return (status.updated_replicas or 0) < replicas - partition or (status.ready_replicas or 0) < replicas
+    # ReplicationController
+    return (status.ready_replicas or 0) < replicas
@@ -0,0 +1,211 @@
+import logging, threading, time, hashlib, bisect, json, os, calendar
+from datetime import datetime
+from kubernetes.client.rest import ApiException
+from custom_libs import apiclient
+
+class HashRing():
+    def __init__(self, members, replicas=100):
+        """
+        Consistent hash ring. Every member gets replicas points on the ring,
+        so when a member joins or leaves only its share of the keys moves
+        """
+
+        self.ring = []
+        for member in members:
+            for i in range(replicas):
+                self.ring.append((get_hash(member + '#' + str(i)), member))
+        self.ring.sort()
+        self.points = [point for (point, member) in self.ring]
+
+    def get_owner(self, key):
+        """
+        Return the member owning the key, None if the ring is empty
+        """
+
+        if not self.ring:
+            return None
+        i = bisect.bisect(self.points, get_hash(key)) % len(self.ring)
+        return self.ring[i][1]
+
+def get_hash(key):
+    return int(hashlib.md5(key.encode('utf8')).hexdigest()[:16], 16)
+
+class MemoryBackend():
+    def __init__(self):
+        """
+        Members are kept in memory. Only useful for tests, with all replicas in one process
+        """
+
+        self.log = logging.getLogger(__name__ + " memory")
+        self.heartbeats = {}
+        self.lock = threading.Lock()
+
+    def heartbeat(self, identity, ttl):
+        with self.lock:
+            self.heartbeats[identity] = time.time() + ttl
+
+    def get_members(self):
+        with self.lock:
+            return [identity for identity in self.heartbeats if self.heartbeats[identity] > time.time()]
+
+    def leave(self, identity):
+        with self.lock:
+            self.heartbeats.pop(identity, None)
+
+class FileBackend():
+    def __init__(self, directory):
+        """
+        Every member writes its expiry time in a file from a shared directory
+        """
+
+        self.log = logging.getLogger(__name__ + " file")
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def heartbeat(self, identity, ttl):
+        path = os.path.join(self.directory, identity)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'expiry': time.time() + ttl}, f)
+        os.rename(path + '.tmp', path)
+
+    def get_members(self):
+        members = []
+        for identity in os.listdir(self.directory):
+            if identity.endswith('.tmp'):
+                continue
+            try:
+                with open(os.path.join(self.directory, identity)) as f:
+                    if json.load(f)['expiry'] > time.time():
+                        members.append(identity)
+            except (IOError, OSError, ValueError, KeyError):
+                self.log.warning("Can't read heartbeat of %s", identity)
+        return members
+
+    def leave(self, identity):
+        try:
+            os.remove(os.path.join(self.directory, identity))
+        except OSError:
+            pass
+
+class LeaseBackend():
+    def __init__(self, namespace, group):
+        """
+        Every member renews its own coordination.k8s.io/v1 Lease, labeled with the group name
+
+        The client version we use doesn't know about Leases, so we call the api directly
+        """
+
+        self.log = logging.getLogger(__name__ + " lease")
+        self.namespace = namespace
+        self.group = group
+        self.api_client = apiclient.get_api_client()
+        self.path = '/apis/coordination.k8s.io/v1/namespaces/{namespace}/leases'
+        self.label = 'opsguru.signature/shard-group'
+
+    def call(self, method, path, query_params=None, body=None, content_type='application/json'):
+        return self.api_client.call_api(path, method, {'namespace': self.namespace}, query_params or [],
+                                        {'Accept': 'application/json', 'Content-Type': content_type},
+                                        body=body, response_type='object', auth_settings=['BearerToken'],
+                                        _return_http_data_only=True)
+
+    def heartbeat(self, identity, ttl):
+        name = self.group + '-' + identity
+        renew_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        spec = {'holderIdentity': identity, 'leaseDurationSeconds': int(ttl), 'renewTime': renew_time}
+        try:
+            self.call('PATCH', self.path + '/' + name, body={'spec': spec}, content_type='application/merge-patch+json')
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            body = {'apiVersion': 'coordination.k8s.io/v1', 'kind': 'Lease',
+                    'metadata': {'name': name, 'labels': {self.label: self.group}}, 'spec': spec}
+            self.call('POST', self.path, body=body)
+
+    def get_members(self):
+        leases = self.call('GET', self.path, query_params=[('labelSelector', self.label + '=' + self.group)])
+        members = []
+        for lease in leases.get('items', []):
+            spec = lease.get('spec', {})
+            if not spec.get('renewTime') or not spec.get('holderIdentity'):
+                continue
+            renew = calendar.timegm(datetime.strptime(spec['renewTime'], '%Y-%m-%dT%H:%M:%S.%fZ').timetuple())
+            if renew + spec.get('leaseDurationSeconds', 0) > time.time():
+                members.append(spec['holderIdentity'])
+        return members
+
+    def leave(self, identity):
+        try:
+            self.call('DELETE', self.path + '/' + self.group + '-' + identity)
+        except ApiException as e:
+            self.log.warning("Can't delete lease: %s", e)
+
+class threadShardManager (threading.Thread):
+    def __init__(self, name, backend, identity, ttl=30, interval=10):
+        """
+        Split the namespaces between all running replicas
+
+        Every interval seconds we renew our membership in the backend and read the live members.
+        Each namespace is owned by one member, chosen with a consistent hash ring.
+        When the members change, the callbacks registered with on_rebalance are called
+        """
+
+        threading.Thread.__init__(self)
+        self.log = logging.getLogger(__name__ + " " + name)
+        self.log.info("Init threadShardManager as %s", identity)
+        self.backend = backend
+        self.identity = identity
+        self.ttl = ttl
+        self.interval = interval
+        self.members = []
+        self.ring = HashRing([identity])
+        self.ring_lock = threading.Lock()
+        self.callbacks = []
+        self.ready = threading.Event()
+
+    def run(self):
+        """
+        Heartbeat and rebalance when the members change
+        """
+        self.log.info("Starting thread")
+
+        while True:
+            try:
+                self.backend.heartbeat(self.identity, self.ttl)
+                members = sorted(set(self.backend.get_members()) | set([self.identity]))
+                if members != self.members:
+                    self.log.info("Shard members changed: %s", ",".join(members))
+                    with self.ring_lock:
+                        self.members = members
+                        self.ring = HashRing(members)
+                    if self.ready.is_set():
+                        for callback in self.callbacks:
+                            callback()
+                self.ready.set()
+            except BaseException as e:
+                self.log.exception('{!r}. Retrying.'.format(e))
+            time.sleep(self.interval)
+
+    def on_rebalance(self, callback):
+        """
+        Register a function called when the namespaces are redistributed
+        """
+
+        self.callbacks.append(callback)
+
+    def get_ring(self):
+        """
+        Return the current ring. A rebalance makes a new one, so it never changes
+        """
+
+        with self.ring_lock:
+            return self.ring
+
+    def owns(self, namespace, ring=None):
+        """
+        Check if the namespace belongs to us, in the current ring or in the one received
+        """
+
+        if ring is None:
+            ring = self.get_ring()
+        return ring.get_owner(namespace) == self.identity
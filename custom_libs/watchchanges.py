@@ -1,137 +1,208 @@
-import logging, threading, time
-from kubernetes import watch, client
-from custom_libs import annotations
-
-use_threads = True
-
-class threadWatchChanges (threading.Thread):
-    def __init__(self, name, queue, obj):
+import logging, threading, time, socket
+from kubernetes.client.rest import ApiException
+from urllib3.exceptions import HTTPError
+from custom_libs import annotations, informer, workqueue
+
+class threadWatchChanges (informer.threadInformer):
+    def __init__(self, name, queue, obj, kind, cache, workers=10, queue_size=1000, digests=None, shards=None,
+                 namespace=None, label_selector=None, field_selector=None, read_func=None, pool=None,
+                 retry_delay=1, max_retry_delay=300):
         """
         On every change of cm/secret this class retrieves all resources using the respective cm/secret
         It will populate a queue with the necessary information
 
-        Receives a queue and a function that lists secrets or configmaps objects
+        Receives a queue, a function that lists secrets or configmaps objects, the kind of the objects
+        and the shared workload cache where we look for the resources
+
+        We only keep the resourceVersion of every cm/secret, not the objects
+
+        Changes are processed by a pool of workers threads. With 0 workers they are processed
+        in the watcher thread. pool is a workqueue.WorkerPool with process_event as target,
+        shared by several watchers, in that case workers and queue_size are not used
+
+        If a digest cache is received, the version of a cm/secret is the digest of the keys used
+        by each controller instead of the resourceVersion
+
+        With shards, we only watch the cm/secrets from namespaces owned by this replica.
+        After a rebalance the cm/secrets of new namespaces are only listed once the workload cache
+        has the controllers of those namespaces, otherwise nobody would be found using them
+
+        With a namespace, obj is a namespaced list function and we only watch that namespace.
+        label_selector and field_selector are applied by the api server
+
+        obj can be a metadata.MetadataLister, so only the metadata of the cm/secrets is received.
+        In that case, the digests need read_func(name, namespace) to read the content.
+        If the read fails, the change is processed again after retry_delay seconds,
+        doubled on every failure up to max_retry_delay
+
+        The versions of the cm/secrets can be saved with get_checkpoint and loaded with restore,
+        so after a restart we resume the watch instead of processing everything again
         """
 
-        threading.Thread.__init__(self)
+        informer.threadInformer.__init__(self, name, obj, kind, handler=self.on_event, keep_objects=False, shards=shards,
+                                         namespace=namespace, label_selector=label_selector, field_selector=field_selector)
         self.log = logging.getLogger(__name__ + " " + name)
         self.log.info("Init threadWatchChanges")
-        self.obj = obj
-        self.v1 = client.CoreV1Api()
-        self.v1b1 = client.AppsV1beta1Api()
-        self.v1b1e = client.ExtensionsV1beta1Api()
+        self.cache = cache
+        self.digests = digests
+        self.read_func = read_func
+        # key -> resourceVersion of the changes not processed yet
+        self.outstanding = {}
+        # key -> number of failed attempts to process the change
+        self.failures = {}
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
         self.ann = annotations.Annotations()
-        # statefulsets 1.7
-        # v1b2 = client.AppsV1beta2Api()
         self.q = queue
+        self.pool = pool
+        if pool is None and workers > 0:
+            self.pool = workqueue.WorkerPool(name, process_event, workers, queue_size)
+            self.pool.start()
 
-    def run(self):
-        """
-        Spawns a new thread of "get_resources_using_obj" function on every change
-
-        Since the watch will eventually timeout, we use an while loop to restart watchers
-        This means that every hour we will iterate over all cm and secrets again
-        """
-        self.log.info("Starting thread")
-
-        w = watch.Watch()
-        while True:
-            try:
-                for event in w.stream(self.obj, _request_timeout=0):
-                    self.log.info("Event: %s %s %s %s %s" % (event['type'], \
-                                                             event['object'].kind, \
-                                                             event['object'].metadata.name, \
-                                                             event['object'].metadata.namespace, \
-                                                             event['object'].metadata.resource_version))
-                    if use_threads:
-                        # we are I/O bound on the network. so threading is helping a little
-                        # (4s vs 8s on my cluster)
-                        t = threading.Thread(target=self.get_resources_using_obj, args = [event['object']])
-                        t.daemon = True
-                        t.start()
-                    else:
-                        self.get_resources_using_obj(event['object'])
-            except BaseException as e:
-                self.log.exception('{!r}. Restarting loop.'.format(e))
-                time.sleep(1)
-        self.log.info("Thread has been stopped")
-
-    def get_resources_using_obj(self, obj):
+    def apply(self, event_type, obj):
+        """
+        Remember that the change is not processed yet before the store is updated
         """
-        We receive an object that has been modified
-        For each controller type, get all volumes/env values and check if it's the received object
-        StatefulSets can't be patched, so we ignore them
 
-        Assumption:
-         - configmaps are only used as volumes
-         - secrets are used as volumes or ENV values
+        if event_type != 'DELETED':
+            with self.store_lock:
+                self.outstanding[self.get_key(obj)] = obj.metadata.resource_version
+        informer.threadInformer.apply(self, event_type, obj)
 
-        We need to send "kind" for each request because of https://github.com/kubernetes-client/python/issues/429
-        (we don't know what kind of resource we have on return)
+    def relist(self):
         """
-        self.log.debug("get_resources_using_obj")
+        Wait for the workload cache to list again after a rebalance.
+        The cache registered for rebalances before us, so it is not synced anymore when we get here
+        """
+
+        self.cache.wait_for_sync()
+        informer.threadInformer.relist(self)
+
+    def on_event(self, event_type, obj, old):
+        """
+        Send every change to the worker pool for "get_resources_using_obj"
+        If we get more changes for the same cm/secret before a worker picks it up,
+        only the newest version is processed
+
+        Since the watch will eventually timeout, the informer resumes it from the last resourceVersion
+        We list all cm and secrets again only if that version is too old, and in that case
+        only the objects with a different version are received here
+        A deleted cm/secret can't be used by new pods, so we ignore it
+        """
+        self.log.info("Event: %s %s %s %s %s" % (event_type, obj.kind, obj.metadata.name, obj.metadata.namespace, obj.metadata.resource_version))
 
-        namespace = obj.metadata.namespace
-        # here threading each request is taking longer then the request 
-        ds = self.v1b1e.list_namespaced_daemon_set(namespace)
-        dp = self.v1b1e.list_namespaced_deployment(namespace)
-        rc = self.v1.list_namespaced_replication_controller(namespace)
-#         ss = self.v1b1.list_namespaced_stateful_set(namespace)
-
-        self.find_resources_using_volume(obj, ds, 'DaemonSet')
-        self.find_resources_using_volume(obj, dp, 'Deployment')
-        self.find_resources_using_volume(obj, rc, 'ReplicationController')
-#         self.find_resources_using_volume(obj, ss, 'StatefulSet')
-        if 'ConfigMap' == obj.kind:
+        if event_type == 'DELETED':
+            if self.digests:
+                self.digests.forget(obj.metadata.namespace, obj.kind, obj.metadata.name)
             return
-        elif 'Secret' == obj.kind:
-            self.find_resources_using_env(obj, ds, 'DaemonSet')
-            self.find_resources_using_env(obj, dp, 'Deployment')
-            self.find_resources_using_env(obj, rc, 'ReplicationController')
-#             self.find_resources_using_env(obj, ss, 'StatefulSet')
+        self.submit(obj, time.time())
+
+    def submit(self, obj, event_time):
+        """
+        Process the change in the worker pool or right away without workers
+        """
+
+        if self.pool:
+            self.pool.submit((obj.metadata.namespace, obj.kind, obj.metadata.name), (self, obj, event_time))
         else:
+            self.get_resources_using_obj(obj, event_time)
+
+    def get_resources_using_obj(self, obj, event_time=None):
+        """
+        We receive an object that has been modified
+        Get from the cache index all controllers that use it as a volume, projected volume,
+        env value or envFrom and send them for update
+        """
+        self.log.debug("get_resources_using_obj")
+
+        if obj.kind not in ('ConfigMap', 'Secret'):
             self.log.critical("Unknown object type: %s", obj.kind)
             return
+        key = self.get_key(obj)
+        try:
+            for (res, kind, keys) in self.cache.get_resources_using(obj.metadata.namespace, obj.kind, obj.metadata.name):
+                self.log.debug("****** %s %s is used by %s (%s)" % (obj.kind, obj.metadata.name, res.metadata.name, kind))
+                self.add_resource_for_update(obj, res, kind, keys, event_time)
+        except (ApiException, HTTPError, socket.error) as e:
+            # reading the content for the digest failed. Our version is already recorded,
+            # so nothing else would process this change again
+            if getattr(e, 'status', None) != 404:
+                self.retry(obj, event_time, e)
+                return
+            self.log.info("%s %s was deleted", obj.kind, key)
+        with self.store_lock:
+            self.failures.pop(key, None)
+            if self.outstanding.get(key) == obj.metadata.resource_version:
+                del self.outstanding[key]
+
+    def retry(self, obj, event_time, error):
+        """
+        Process the change again later, unless a newer one came meanwhile
+        It stays outstanding, so a checkpoint doesn't count it as processed
+        """
+
+        key = self.get_key(obj)
+        with self.store_lock:
+            failures = self.failures.get(key, 0)
+            self.failures[key] = failures + 1
+        delay = min(self.retry_delay * 2 ** failures, self.max_retry_delay)
+        self.log.error("Can't process %s %s: %s. Retry in %ss", obj.kind, key, error, delay)
+        t = threading.Timer(delay, self.resubmit, (obj, event_time))
+        t.daemon = True
+        t.start()
+
+    def resubmit(self, obj, event_time):
+        """
+        Timer target for retry
+        """
+
+        key = self.get_key(obj)
+        with self.store_lock:
+            current = self.versions.get(key) == obj.metadata.resource_version
+            if not current and key not in self.versions:
+                self.failures.pop(key, None)
+        if current:
+            self.submit(obj, event_time)
+
+    def get_checkpoint(self):
+        """
+        Return the versions of the cm/secrets that were processed and the resourceVersion to resume the watch
 
-    def find_resources_using_volume(self, obj, resources, kind):
+        Changes that are not processed yet are left out, so they are seen again after a restart.
+        If there are any, we can't resume from the current resourceVersion and a new list is needed
         """
-        When we find a volume on the respective resources that it's the same as the desired one,
-        send it for update (put resource+environment in a queue)
-        
-        We don't check that the volume is actually mounted inside any container
+        self.log.debug("get_checkpoint")
+
+        resource_version = self.resource_version
+        with self.store_lock:
+            versions = dict((key, version) for (key, version) in self.versions.items() if key not in self.outstanding)
+            if self.outstanding:
+                resource_version = None
+        return {'resource_version': resource_version, 'versions': versions}
+
+    def restore(self, checkpoint):
+        """
+        Load the versions from a checkpoint. Must be called before the thread is started
+        With a resourceVersion we only watch, otherwise the first list sends only what changed
         """
-        self.log.debug("find_resources_using_volume")
+        self.log.info("Restoring %s versions at resourceVersion %s", len(checkpoint['versions']), checkpoint['resource_version'])
 
-        vol_name = obj.metadata.name
-        for res in resources.items:
-            if res.spec.template.spec.volumes:
-                for volume in res.spec.template.spec.volumes:
-                    if obj.kind == 'ConfigMap' and volume.config_map and volume.config_map.name and volume.config_map.name == vol_name:
-                        self.log.debug("****** Vol %s is used by %s (%s)" % (vol_name, res.metadata.name, obj.kind))
-                        self.add_resource_for_update(obj, res, kind)
-                        break
-                    if obj.kind == 'Secret' and volume.secret and volume.secret.secret_name and volume.secret.secret_name == vol_name:
-                        self.log.debug("****** Vol secret %s is used by %s (%s)" % (vol_name, res.metadata.name, obj.kind))
-                        self.add_resource_for_update(obj, res, kind)
-                        break
+        with self.store_lock:
+            self.versions.update(checkpoint['versions'])
+        self.resource_version = checkpoint['resource_version']
+        if self.resource_version:
+            self.synced.set()
 
-    def find_resources_using_env(self, obj, resources, kind):
+    def get_version(self, obj, keys):
         """
-        When we find an environment value on the respective resources that it's the same as the desired one,
-        send it for update (put resource+environment in a queue)
+        Return the digest of the keys used from the object or its resourceVersion
         """
-        self.log.debug("find_resources_using_env")
 
-        env_name = obj.metadata.name
-        for res in resources.items:
-            for container in res.spec.template.spec.containers:
-                if container.env:
-                    for env in container.env:
-                        if env.value_from and env.value_from.secret_key_ref and env.value_from.secret_key_ref.name == env_name:
-                            self.log.debug("****** ENV %s is used by %s (%s)" % (env_name, res.metadata.name, obj.kind))
-                            self.add_resource_for_update(obj, res, kind)
+        if self.digests:
+            return self.digests.get_digest(obj, keys, self.read_func)
+        return obj.metadata.resource_version
 
-    def add_resource_for_update(self, obj, res, kind):
+    def add_resource_for_update(self, obj, res, kind, keys=None, event_time=None):
         """
         Check if the controller has our annotation (signature).
         Only those elements are managed by us
@@ -144,7 +215,8 @@ class threadWatchChanges (threading.Thread):
         if not self.ann.has_signature(res):
             return
         annotation_ver = self.ann.get_version(res, obj.kind, obj.metadata.name)
-        if str(annotation_ver) == str(obj.metadata.resource_version):
+        cfg_version = self.get_version(obj, keys)
+        if str(annotation_ver) == str(cfg_version):
             return
 
         self.log.info("Send for update %s %s/%s by %s/%s" % (kind, res.metadata.namespace, res.metadata.name, obj.kind, obj.metadata.name))
@@ -154,6 +226,15 @@ class threadWatchChanges (threading.Thread):
                 'res_kind': kind,
                 'cfg_kind': obj.kind,
                 'cfg_name': obj.metadata.name,
-                'cfg_version': obj.metadata.resource_version,
+                'cfg_version': cfg_version,
+                'event_time': event_time or time.time(),
                 }
         self.q.put(item)
+
+def process_event(item):
+    """
+    Worker pool target. Items are (watcher, object, time of the event)
+    """
+
+    (watcher, obj, event_time) = item
+    watcher.get_resources_using_obj(obj, event_time)
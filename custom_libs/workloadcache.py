@@ -0,0 +1,84 @@
+import logging, functools
+from kubernetes import client
+from custom_libs import informer, workloadindex, apiclient
+
+class WorkloadCache():
+    def __init__(self, shards=None):
+        """
+        Shared local copy of all controllers that can use configmaps and secrets
+
+        One informer is started for each controller kind. They list everything once
+        and after that they only apply the changes received from the watchers,
+        so readers never have to call the api
+
+        Every event is also applied on a reverse index from configs to controllers
+
+        With shards, we only keep the controllers from namespaces owned by this replica
+        """
+
+        self.log = logging.getLogger(__name__)
+        self.log.info("Init WorkloadCache")
+        self.v1 = client.CoreV1Api(apiclient.get_api_client())
+        self.v1b1 = client.AppsV1beta1Api(apiclient.get_api_client())
+        self.v1b1e = client.ExtensionsV1beta1Api(apiclient.get_api_client())
+        self.index = workloadindex.WorkloadIndex()
+        self.informers = {
+                'DaemonSet': informer.threadInformer("daemonsets", self.v1b1e.list_daemon_set_for_all_namespaces, 'DaemonSet',
+                                                     functools.partial(self.index.apply, 'DaemonSet'), shards=shards),
+                'Deployment': informer.threadInformer("deployments", self.v1b1e.list_deployment_for_all_namespaces, 'Deployment',
+                                                      functools.partial(self.index.apply, 'Deployment'), shards=shards),
+                'ReplicationController': informer.threadInformer("replicationcontrollers", self.v1.list_replication_controller_for_all_namespaces, 'ReplicationController',
+                                                                 functools.partial(self.index.apply, 'ReplicationController'), shards=shards),
+                'StatefulSet': informer.threadInformer("statefulsets", self.v1b1.list_stateful_set_for_all_namespaces, 'StatefulSet',
+                                                       functools.partial(self.index.apply, 'StatefulSet'), shards=shards),
+                }
+
+    def start(self):
+        """
+        Start all informers
+        """
+        self.log.info("Starting informers")
+
+        for kind in self.informers:
+            self.informers[kind].daemon = True
+            self.informers[kind].start()
+
+    def wait_for_sync(self, timeout=None):
+        """
+        Block until every informer did the initial list
+        """
+        self.log.info("Waiting for informers to sync")
+
+        for kind in self.informers:
+            if not self.informers[kind].synced.wait(timeout):
+                return False
+        return True
+
+    def get(self, namespace, name, kind):
+        """
+        Return the controller or None if we don't know about it
+        """
+        self.log.debug("get %s %s/%s", kind, namespace, name)
+
+        return self.informers[kind].get(namespace + "/" + name)
+
+    def list(self, namespace, kind):
+        """
+        Return all controllers of the respective kind from the namespace
+        """
+        self.log.debug("list %s %s", kind, namespace)
+
+        return self.informers[kind].list(namespace)
+
+    def get_resources_using(self, namespace, cfg_kind, cfg_name):
+        """
+        Return a list of (controller, kind, keys) for all controllers using the config
+        """
+        self.log.debug("get_resources_using %s %s/%s", cfg_kind, namespace, cfg_name)
+
+        resources = []
+        for (kind, name, keys) in self.index.get_users(namespace, cfg_kind, cfg_name):
+            res = self.get(namespace, name, kind)
+            if res is not None:
+                resources.append((res, kind, keys))
+        return resources
@@ -0,0 +1,116 @@
+import logging, threading
+
+class WorkloadIndex():
+    def __init__(self):
+        """
+        Reverse index from a configmap/secret to the controllers that use it
+
+        The index is kept up to date by the workload cache informers on every event,
+        so finding the controllers for a config is a single dict lookup
+
+        For each reference we also keep the keys that are consumed from the config.
+        None means that the whole config is used (volumes without items, envFrom)
+        """
+
+        self.log = logging.getLogger(__name__)
+        self.log.info("Init WorkloadIndex")
+        # (namespace, cfg_kind, cfg_name) -> {(kind, name): keys}
+        self.index = {}
+        # (namespace, kind, name) -> {(cfg_kind, cfg_name): keys}
+        self.references = {}
+        self.index_lock = threading.Lock()
+
+    def apply(self, kind, event_type, res, old=None):
+        """
+        Informer handler. Replace all references of the controller with the new ones
+        """
+        self.log.debug("apply %s %s %s/%s" % (event_type, kind, res.metadata.namespace, res.metadata.name))
+
+        namespace = res.metadata.namespace
+        name = res.metadata.name
+        if event_type == 'DELETED':
+            refs = {}
+        else:
+            refs = get_references(res)
+        with self.index_lock:
+            for cfg in self.references.pop((namespace, kind, name), {}):
+                users = self.index.get((namespace,) + cfg)
+                if users is not None:
+                    users.pop((kind, name), None)
+                    if not users:
+                        del self.index[(namespace,) + cfg]
+            if refs:
+                self.references[(namespace, kind, name)] = refs
+            for cfg in refs:
+                self.index.setdefault((namespace,) + cfg, {})[(kind, name)] = refs[cfg]
+
+    def get_users(self, namespace, cfg_kind, cfg_name):
+        """
+        Return a list of (kind, name, keys) for all controllers using the config
+        """
+        self.log.debug("get_users %s %s/%s", cfg_kind, namespace, cfg_name)
+
+        with self.index_lock:
+            users = self.index.get((namespace, cfg_kind, cfg_name), {})
+            return [(kind, name, users[(kind, name)]) for (kind, name) in users]
+
+def add_reference(refs, cfg_kind, cfg_name, keys):
+    """
+    Merge the keys of a new reference with what we already have
+    """
+
+    if not cfg_name:
+        return
+    cfg = (cfg_kind, cfg_name)
+    if cfg in refs and (refs[cfg] is None or keys is None):
+        refs[cfg] = None
+    elif cfg in refs:
+        refs[cfg] = refs[cfg] | keys
+    else:
+        refs[cfg] = keys
+
+def get_item_keys(items):
+    """
+    Volumes with items only use the listed keys
+    """
+
+    if not items:
+        return None
+    return set(item.key for item in items)
+
+def get_references(res):
+    """
+    Return all configmaps/secrets used by the controller with the keys that are used
+
+    We look at:
+     - volumes and projected volumes
+     - env values from secretKeyRef/configMapKeyRef
+     - envFrom
+    for containers and init containers
+    """
+
+    refs = {}
+    spec = res.spec.template.spec
+    for volume in spec.volumes or []:
+        if volume.config_map:
+            add_reference(refs, 'ConfigMap', volume.config_map.name, get_item_keys(volume.config_map.items))
+        if volume.secret:
+            add_reference(refs, 'Secret', volume.secret.secret_name, get_item_keys(volume.secret.items))
+        if volume.projected:
+            for source in volume.projected.sources or []:
+                if source.config_map:
+                    add_reference(refs, 'ConfigMap', source.config_map.name, get_item_keys(source.config_map.items))
+                if source.secret:
+                    add_reference(refs, 'Secret', source.secret.name, get_item_keys(source.secret.items))
+    for container in (spec.containers or []) + (spec.init_containers or []):
+        for env in container.env or []:
+            if env.value_from and env.value_from.secret_key_ref:
+                add_reference(refs, 'Secret', env.value_from.secret_key_ref.name, set([env.value_from.secret_key_ref.key]))
+            if env.value_from and env.value_from.config_map_key_ref:
+                add_reference(refs, 'ConfigMap', env.value_from.config_map_key_ref.name, set([env.value_from.config_map_key_ref.key]))
+        for env_from in container.env_from or []:
+            if env_from.config_map_ref:
+                add_reference(refs, 'ConfigMap', env_from.config_map_ref.name, None)
+            if env_from.secret_ref:
+                add_reference(refs, 'Secret', env_from.secret_ref.name, None)
+    return refs
@@ -0,0 +1,65 @@
+import logging, threading
+from Queue import Queue
+from custom_libs import metrics
+
+class WorkerPool():
+    def __init__(self, name, target, workers=10, queue_size=1000):
+        """
+        Fixed number of threads that call target(item) for submitted items
+
+        Items are identified by a key. If an item is submitted again before a worker
+        picked it up, we only keep the newest one and it is processed once
+
+        When queue_size keys are waiting, submit blocks until a worker is free
+        """
+
+        self.log = logging.getLogger(__name__ + " " + name)
+        self.log.info("Init WorkerPool with %s workers", workers)
+        self.target = target
+        self.workers = workers
+        self.q = Queue(queue_size)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        metrics.workers.labels(name).set(workers)
+        metrics.queue_depth.labels(name).set_function(self.q.qsize)
+
+    def start(self):
+        """
+        Start all worker threads
+        """
+        self.log.info("Starting workers")
+
+        for i in range(self.workers):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+
+    def submit(self, key, item):
+        """
+        Add the item for processing or replace the one that is already waiting
+        """
+        self.log.debug("submit %s", key)
+
+        with self.pending_lock:
+            waiting = key in self.pending
+            self.pending[key] = item
+        if waiting:
+            self.log.debug("Coalesced %s", key)
+            return
+        self.q.put(key)
+
+    def work(self):
+        """
+        Get keys from the queue and process the newest item for each of them
+        """
+        self.log.debug("Worker started")
+
+        while True:
+            key = self.q.get()
+            with self.pending_lock:
+                item = self.pending.pop(key)
+            try:
+                self.target(item)
+            except BaseException as e:
+                self.log.exception('{!r}. Continue with next item.'.format(e))
+            self.q.task_done()
@@ -1,47 +1,177 @@
 #!/bin/python
 from __future__ import print_function
-import logging, traceback, time, signal, sys, threading, os
-from custom_libs import logger, watchchanges, applychanges
+import os
+runtime = os.getenv('RUNTIME', 'threads')
+if runtime == 'gevent':
+    # All threads become greenlets on one event loop and all api calls are non blocking.
+    # This must be done before anything else is imported
+    from gevent import monkey
+    monkey.patch_all()
+import logging, traceback, time, signal, sys, threading
+from custom_libs import logger, watchchanges, applychanges, workloadcache, podcache, digests, adoption, metrics, sharding, metadata, checkpoint, apiclient, workqueue
 from kubernetes import client, config
 from Queue import Queue 
 
+shards = None
+checkpointer = None
+
 def signal_handler(signal, frame):
+        if checkpointer:
+            checkpointer.save()
+        if shards:
+            # let the other replicas take our namespaces now
+            shards.backend.leave(shards.identity)
         sys.exit(0)
 signal.signal(signal.SIGINT, signal_handler)
+signal.signal(signal.SIGTERM, signal_handler)
 
-update_resource_timeout = os.getenv('UPDATE_RESOURCE_TIMEOUT', 300)
+# greenlets are cheap, so we can have a lot more workers
+default_workers = 200 if runtime == 'gevent' else 10
+update_resource_timeout = int(os.getenv('UPDATE_RESOURCE_TIMEOUT', 300))
+min_debounce = float(os.getenv('MIN_DEBOUNCE', 30))
+max_wait = float(os.getenv('MAX_WAIT', update_resource_timeout))
+watch_workers = int(os.getenv('WATCH_WORKERS', default_workers))
+watch_queue_size = int(os.getenv('WATCH_QUEUE_SIZE', 1000))
+patch_workers = int(os.getenv('PATCH_WORKERS', default_workers))
+max_rollouts = int(os.getenv('MAX_ROLLOUTS', 0))
+max_unavailable = os.getenv('MAX_UNAVAILABLE', '25%')
+restart_interval = float(os.getenv('RESTART_INTERVAL', 5))
+max_rollouts_per_namespace = int(os.getenv('MAX_ROLLOUTS_PER_NAMESPACE', 0))
+rollout_timeout = float(os.getenv('ROLLOUT_TIMEOUT', 600))
+patch_rate = float(os.getenv('PATCH_RATE', 0))
+patch_burst = int(os.getenv('PATCH_BURST', 1))
+metrics_port = int(os.getenv('METRICS_PORT', 8080))
+version_mode = os.getenv('VERSION_MODE', 'resource_version')
+watch_mode = os.getenv('WATCH_MODE', 'full')
+watch_namespaces = [ns for ns in os.getenv('WATCH_NAMESPACES', '').split(',') if ns]
+watch_label_selector = os.getenv('WATCH_LABEL_SELECTOR') or None
+watch_field_selector = os.getenv('WATCH_FIELD_SELECTOR') or None
+sharding_backend = os.getenv('SHARDING', 'none')
+shard_id = os.getenv('SHARD_ID', os.getenv('HOSTNAME', 'localhost'))
+shard_group = os.getenv('SHARD_GROUP', 'updateresources')
+shard_lease_namespace = os.getenv('SHARD_LEASE_NAMESPACE', 'default')
+shard_dir = os.getenv('SHARD_DIR', '/tmp/updateresources-shards')
+shard_ttl = int(os.getenv('SHARD_TTL', 30))
+adopt_on_start = os.getenv('ADOPT_ON_START', 'False') == 'True'
+adopt_batch_size = int(os.getenv('ADOPT_BATCH_SIZE', 20))
+adopt_batch_interval = float(os.getenv('ADOPT_BATCH_INTERVAL', 1))
+api_pool_size = int(os.getenv('API_POOL_SIZE', default_workers * 5))
+api_gzip = os.getenv('API_GZIP', 'True') == 'True'
+list_page_size = int(os.getenv('LIST_PAGE_SIZE', 500))
+checkpoint_file = os.getenv('CHECKPOINT_FILE', '')
+checkpoint_interval = float(os.getenv('CHECKPOINT_INTERVAL', 10))
 
 if __name__ == '__main__':
     """
+    Start the shared cache of controllers and the cache of pods.
+
+    If asked, record the current config versions on all controllers before anything else,
+    so they are not restarted.
+
     Start watchers for configmap and secret changes.
     When something is updated, a queue is populated with relevant info for an update
 
     Start a worker that gets elements from the queue and updates/restarts resources accordingly
+
+    With a checkpoint file, watchers and worker resume from the saved state and the state is saved periodically
     """
 
     try:
         logger.Mylog()
         log = logging.getLogger(__name__)
+        log.info("Using %s runtime", runtime)
         log.info("Loading kubernetes config")
         config.load_incluster_config()
-        config.connection_pool_maxsize = 500
         # config.load_kube_config('/etc/kubernetes/admin.conf')
-        v1 = client.CoreV1Api()
+        apiclient.setup(api_pool_size, api_gzip, list_page_size)
+        v1 = client.CoreV1Api(apiclient.get_api_client())
         q = Queue()
+
+        if metrics_port:
+            metrics.start_server(metrics_port)
+            metrics.queue_depth.labels('changes').set_function(q.qsize)
+
+        if sharding_backend != 'none':
+            log.info("Starting shard manager with %s backend", sharding_backend)
+            backend = {
+                    'lease': lambda: sharding.LeaseBackend(shard_lease_namespace, shard_group),
+                    'file': lambda: sharding.FileBackend(shard_dir),
+                    'memory': sharding.MemoryBackend,
+                    }[sharding_backend]()
+            shards = sharding.threadShardManager("shards", backend, shard_id, shard_ttl, shard_ttl / 3)
+            shards.daemon = True
+            shards.start()
+            shards.ready.wait()
+
+        log.info("Starting workload cache")
+        cache = workloadcache.WorkloadCache(shards)
+        cache.start()
+        cache.wait_for_sync()
+
+        log.info("Starting pod cache")
+        pod_cache = podcache.PodCache(shards)
+        pod_cache.start()
+        pod_cache.wait_for_sync()
  
-        log.info("Starting watchers")
-        cm = watchchanges.threadWatchChanges("configmaps", q, v1.list_config_map_for_all_namespaces)
-        cm.daemon = True
-        cm.start()
-        secret = watchchanges.threadWatchChanges("secrets", q, v1.list_secret_for_all_namespaces)
-        secret.daemon = True
-        secret.start()
+        digest_cache = None
+        if version_mode == 'content':
+            log.info("Using content digests as config versions")
+            digest_cache = digests.DigestCache()
+
+        if adopt_on_start:
+            log.info("Starting adoption")
+            adopt = adoption.threadAdoption("adoption", cache, digest_cache, adopt_batch_size, adopt_batch_interval)
+            adopt.daemon = True
+            adopt.start()
+            adopt.finished.wait()
+
+        state = checkpoint.load(checkpoint_file) if checkpoint_file else None
+
+        log.info("Starting watchers in %s mode", watch_mode)
+        watchers = {}
+        watched = [
+                ("configmaps", 'ConfigMap', v1.list_config_map_for_all_namespaces, v1.list_namespaced_config_map, v1.read_namespaced_config_map),
+                ("secrets", 'Secret', v1.list_secret_for_all_namespaces, v1.list_namespaced_secret, v1.read_namespaced_secret),
+                ]
+        for (name, kind, list_all, list_namespaced, read_func) in watched:
+            # the watchers of all namespaces share the workers
+            pool = None
+            if watch_workers > 0:
+                pool = workqueue.WorkerPool(name, watchchanges.process_event, watch_workers, watch_queue_size)
+                pool.start()
+            for namespace in watch_namespaces or [None]:
+                if watch_mode == 'metadata':
+                    (list_func, read) = (metadata.MetadataLister(kind), read_func)
+                else:
+                    (list_func, read) = (list_namespaced if namespace else list_all, None)
+                watcher_name = name + ('-' + namespace if namespace else '')
+                watcher = watchchanges.threadWatchChanges(watcher_name, q, list_func, kind, cache,
+                                                          watch_workers, watch_queue_size, digest_cache, shards,
+                                                          namespace, watch_label_selector, watch_field_selector, read, pool)
+                if state and watcher_name in state['watchers']:
+                    watcher.restore(state['watchers'][watcher_name])
+                watcher.daemon = True
+                watcher.start()
+                watchers[watcher_name] = watcher
  
         log.info("Starting worker")
-        worker = applychanges.threadApplyChanges("worker", q, update_resource_timeout)
+        worker = applychanges.threadApplyChanges("worker", q, cache, pod_cache, update_resource_timeout,
+                                                 patch_workers=patch_workers, max_rollouts=max_rollouts,
+                                                 max_rollouts_per_namespace=max_rollouts_per_namespace, rollout_timeout=rollout_timeout,
+                                                 patch_rate=patch_rate, patch_burst=patch_burst,
+                                                 min_debounce=min_debounce, max_wait=max_wait,
+                                                 max_unavailable=max_unavailable, restart_interval=restart_interval)
+        if state:
+            worker.restore(state['worker'])
         worker.daemon = True
         worker.start()
 
+        if checkpoint_file:
+            log.info("Starting checkpoints")
+            checkpointer = checkpoint.threadCheckpoint("checkpoint", checkpoint_file, watchers, worker, checkpoint_interval)
+            checkpointer.daemon = True
+            checkpointer.start()
+
         while True:
             # Main thread sleeping for ever
             log.debug("Current number of threads: " + str(threading.active_count()))
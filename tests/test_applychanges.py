@@ -0,0 +1,118 @@
+import time, unittest, Queue
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from urllib3.exceptions import MaxRetryError
+from custom_libs import applychanges
+
+class FakeCache():
+    def get(self, namespace, name, kind):
+        template = client.V1PodTemplateSpec(metadata=client.V1ObjectMeta(annotations={}))
+        return client.ExtensionsV1beta1Deployment(metadata=client.V1ObjectMeta(namespace=namespace, name=name, generation=1),
+                                                  spec=client.ExtensionsV1beta1DeploymentSpec(template=template))
+
+def pending(name, expiry, changes=None):
+    now = time.time()
+    return {'name': name, 'namespace': 'ns', 'kind': 'Deployment', 'changes': changes or {'opsguru.signature/ConfigMap.cm': '2'},
+            'time': now, 'last': now, 'quiet': expiry - now, 'max_wait': 300, 'retries': 0, 'event_time': now,
+            'patch_func': None, 'update_function': None}
+
+class WorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.worker = applychanges.threadApplyChanges("worker", Queue.Queue(), FakeCache(), FakeCache(), 300,
+                                                      retry_delay=60, max_retry_delay=600, patch_retries=2, restart_interval=3600)
+        # record what the update thread sends to the patch workers
+        self.submitted = Queue.Queue()
+        self.worker.patch_pool.submit = lambda key, value: self.submitted.put((time.time(), value))
+
+    def add(self, value):
+        with self.worker.for_update_lock:
+            self.worker.add_for_update(value['namespace'] + "/" + value['name'], value)
+
+class TestSchedule(WorkerTestCase):
+    def test_entries_fire_at_their_own_deadline(self):
+        now = time.time()
+        self.add(pending('app-0', now + 0.3))
+        self.add(pending('app-1', now + 0.1))
+        (fired, value) = self.submitted.get(timeout=5)
+        self.assertEqual(value['name'], 'app-1')
+        self.assertGreaterEqual(fired, now + 0.1)
+        self.assertLess(fired, now + 0.3)
+        (fired, value) = self.submitted.get(timeout=5)
+        self.assertEqual(value['name'], 'app-0')
+        self.assertGreaterEqual(fired, now + 0.3)
+
+    def test_rescheduled_entry_fires_once(self):
+        now = time.time()
+        value = pending('app-0', now + 0.1)
+        self.add(value)
+        with self.worker.for_update_lock:
+            value['last'] = now + 0.2
+            self.worker.add_for_update('ns/app-0', value)
+        (fired, value) = self.submitted.get(timeout=5)
+        self.assertGreaterEqual(fired, now + 0.3)
+        time.sleep(0.2)
+        self.assertTrue(self.submitted.empty())
+        self.assertIn('ns/app-0', self.worker.patching)
+
+    def test_removed_entry_never_fires(self):
+        self.add(pending('app-0', time.time() + 0.1))
+        with self.worker.for_update_lock:
+            del self.worker.for_update['ns/app-0']
+        time.sleep(0.3)
+        self.assertTrue(self.submitted.empty())
+
+class TestPatch(WorkerTestCase):
+    def failing(self, error):
+        def patch_func(name, namespace, body):
+            raise error
+        return patch_func
+
+    def failed_value(self, error, changes=None):
+        value = pending('app-0', time.time(), changes)
+        value['patch_func'] = self.failing(error)
+        return value
+
+    def test_failed_patch_is_retried_with_backoff(self):
+        value = self.failed_value(ApiException(status=500))
+        start = time.time()
+        self.worker.patch(value)
+        with self.worker.for_update_lock:
+            self.assertIs(self.worker.for_update['ns/app-0'], value)
+        self.assertEqual(value['retries'], 1)
+        self.assertAlmostEqual(value['retry_at'], start + 120, delta=5)
+
+    def test_transport_errors_are_retried(self):
+        value = self.failed_value(MaxRetryError(None, '/', 'refused'))
+        self.worker.patch(value)
+        with self.worker.for_update_lock:
+            self.assertIs(self.worker.for_update['ns/app-0'], value)
+
+    def test_failed_patch_merges_into_newer_entry(self):
+        newer = pending('app-0', time.time() + 100, {'opsguru.signature/Secret.s': '3'})
+        self.add(newer)
+        value = self.failed_value(ApiException(status=500))
+        value['event_time'] -= 10
+        self.worker.patch(value)
+        with self.worker.for_update_lock:
+            entry = self.worker.for_update['ns/app-0']
+        self.assertIs(entry, newer)
+        self.assertEqual(entry['changes'], {'opsguru.signature/ConfigMap.cm': '2', 'opsguru.signature/Secret.s': '3'})
+        self.assertEqual(entry['event_time'], value['event_time'])
+        self.assertNotIn('retry_at', entry)
+
+    def test_gives_up_after_patch_retries(self):
+        value = self.failed_value(ApiException(status=500))
+        for retries in (1, 2):
+            self.worker.patch(value)
+            with self.worker.for_update_lock:
+                self.assertIs(self.worker.for_update.pop('ns/app-0'), value)
+            self.assertEqual(value['retries'], retries)
+        self.worker.patch(value)
+        self.assertNotIn('ns/app-0', self.worker.for_update)
+
+    def test_not_found_is_not_retried(self):
+        self.worker.patch(self.failed_value(ApiException(status=404)))
+        self.assertNotIn('ns/app-0', self.worker.for_update)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import json, os, shutil, tempfile, threading, time, unittest, Queue
+from kubernetes import client
+from custom_libs import applychanges, checkpoint, watchchanges
+
+class FakeCache():
+    def get(self, namespace, name, kind):
+        return None
+
+    def wait_for_sync(self, timeout=None):
+        return True
+
+    def get_resources_using(self, namespace, cfg_kind, cfg_name):
+        return []
+
+def make_worker():
+    worker = applychanges.threadApplyChanges("worker", Queue.Queue(), FakeCache(), FakeCache(), 300, restart_interval=3600)
+    # record what the update thread sends to the patch workers
+    worker.submitted = Queue.Queue()
+    worker.patch_pool.submit = lambda key, value: worker.submitted.put(value)
+    return worker
+
+def pending(name, start, retry_at=None):
+    value = {'name': name, 'namespace': 'ns', 'kind': 'Deployment', 'changes': {'opsguru.signature/ConfigMap.cm': '2'},
+             'time': start, 'last': start, 'quiet': 100, 'max_wait': 300, 'retries': 0, 'event_time': start - 1}
+    if retry_at is not None:
+        value.update({'retry_at': retry_at, 'retries': 1})
+    return value
+
+def config_map(name, version):
+    return client.V1ConfigMap(kind='ConfigMap', metadata=client.V1ObjectMeta(namespace='ns', name=name, resource_version=version))
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'checkpoint.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_watcher(self):
+        return watchchanges.threadWatchChanges("configmaps", Queue.Queue(), None, 'ConfigMap', FakeCache(), 0)
+
+    def test_round_trip(self):
+        now = time.time()
+        worker = make_worker()
+        worker.restore({'items': [], 'pending': [pending('app-0', now), pending('app-1', now, now + 50)]})
+        item = {'res_namespace': 'ns', 'res_kind': 'Deployment', 'res_name': 'app-2',
+                'cfg_kind': 'ConfigMap', 'cfg_name': 'cm', 'cfg_version': '2', 'event_time': now}
+        worker.waiting[worker.get_item_key(item)] = item
+        watcher = self.make_watcher()
+        watcher.apply('ADDED', config_map('cm-0', '1'))
+        watcher.resource_version = '10'
+
+        checkpoint.threadCheckpoint("checkpoint", self.path, {'configmaps': watcher}, worker).save()
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        state = checkpoint.load(self.path)
+
+        restored = make_worker()
+        restored.restore(state['worker'])
+        with restored.for_update_lock:
+            self.assertEqual(restored.for_update['ns/app-0']['time'], now)
+            self.assertEqual(restored.for_update['ns/app-1']['retry_at'], now + 50)
+            self.assertEqual(restored.for_update['ns/app-1']['retries'], 1)
+        # the intake thread moves the items from the queue to the waiting dict
+        restored.q.join()
+        self.assertEqual(restored.waiting, {restored.get_item_key(item): item})
+        self.assertTrue(restored.submitted.empty())
+
+        restored_watcher = self.make_watcher()
+        restored_watcher.restore(state['watchers']['configmaps'])
+        self.assertEqual(restored_watcher.resource_version, '10')
+        self.assertEqual(restored_watcher.versions, {'ns/cm-0': '1'})
+        self.assertTrue(restored_watcher.synced.is_set())
+
+    def test_expired_entries_fire_on_restore(self):
+        now = time.time()
+        worker = make_worker()
+        worker.restore(json.loads(json.dumps({'items': [], 'pending': [pending('app-0', now - 1000), pending('app-1', now)]})))
+        value = worker.submitted.get(timeout=5)
+        self.assertEqual(value['name'], 'app-0')
+        self.assertTrue(worker.submitted.empty())
+
+    def test_outstanding_changes_need_a_list(self):
+        watcher = self.make_watcher()
+        watcher.resource_version = '10'
+        watcher.versions['ns/cm-0'] = '1'
+        # received but not processed yet
+        with watcher.store_lock:
+            watcher.outstanding['ns/cm-1'] = '2'
+            watcher.versions['ns/cm-1'] = '2'
+        state = json.loads(json.dumps(watcher.get_checkpoint()))
+        self.assertEqual(state, {'resource_version': None, 'versions': {'ns/cm-0': '1'}})
+
+        restored = self.make_watcher()
+        restored.restore(state)
+        self.assertIsNone(restored.resource_version)
+        self.assertFalse(restored.synced.is_set())
+
+    def test_load_ignores_other_versions(self):
+        with open(self.path, 'w') as f:
+            json.dump({'version': checkpoint.VERSION + 1, 'time': time.time()}, f)
+        self.assertIsNone(checkpoint.load(self.path))
+        with open(self.path, 'w') as f:
+            f.write('{')
+        self.assertIsNone(checkpoint.load(self.path))
+        self.assertIsNone(checkpoint.load(self.path + '.missing'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+from kubernetes import client
+from custom_libs import annotations, applychanges, debounce
+
+class TestDebouncer(unittest.TestCase):
+    def setUp(self):
+        self.debouncer = debounce.Debouncer("test", 10, 300, alpha=0.5)
+
+    def test_first_change_waits_min_delay(self):
+        self.assertEqual(self.debouncer.observe('ns/app', 1000), 10)
+
+    def test_burst_waits_twice_the_gap(self):
+        self.debouncer.observe('ns/app', 1000)
+        self.assertEqual(self.debouncer.observe('ns/app', 1040), 80)
+        # average of 40 and 60
+        self.assertEqual(self.debouncer.observe('ns/app', 1100), 100)
+
+    def test_isolated_changes_decay(self):
+        self.debouncer.observe('ns/app', 1000)
+        self.debouncer.observe('ns/app', 1040)
+        self.assertEqual(self.debouncer.observe('ns/app', 2000), 40)
+        self.assertEqual(self.debouncer.observe('ns/app', 3000), 20)
+        self.assertEqual(self.debouncer.observe('ns/app', 4000), 10)
+        self.assertEqual(self.debouncer.state['ns/app'], (4000, 5))
+        # the gap fell below half the min delay and is forgotten
+        self.assertEqual(self.debouncer.observe('ns/app', 5000), 10)
+        self.assertEqual(self.debouncer.state['ns/app'], (5000, None))
+
+    def test_min_clamp(self):
+        self.debouncer.observe('ns/app', 1000)
+        self.assertEqual(self.debouncer.observe('ns/app', 1001), 10)
+
+    def test_max_clamp(self):
+        self.debouncer.observe('ns/app', 1000)
+        self.assertEqual(self.debouncer.observe('ns/app', 1250), 300)
+
+    def test_out_of_order_changes(self):
+        self.debouncer.observe('ns/app', 1000)
+        self.assertEqual(self.debouncer.observe('ns/app', 980), 40)
+        self.assertEqual(self.debouncer.state['ns/app'][0], 1000)
+
+    def test_controllers_are_independent(self):
+        self.debouncer.observe('ns/app', 1000)
+        self.debouncer.observe('ns/app', 1040)
+        self.assertEqual(self.debouncer.observe('ns/other', 1040), 10)
+
+    def test_forget(self):
+        self.debouncer.observe('ns/app', 1000)
+        self.debouncer.forget('ns/app')
+        self.assertEqual(self.debouncer.observe('ns/app', 1040), 10)
+
+class FakeCache():
+    def __init__(self, res):
+        self.res = res
+
+    def get(self, namespace, name, kind):
+        return self.res
+
+class TestDebounceAnnotations(unittest.TestCase):
+    def setUp(self):
+        # only what get_debounce needs, without starting the threads
+        self.worker = applychanges.threadApplyChanges.__new__(applychanges.threadApplyChanges)
+        self.worker.debouncer = debounce.Debouncer("test", 10, 300)
+        self.worker.ann = annotations.Annotations()
+        self.worker.max_wait = 300
+
+    def get_debounce(self, annotations, event_time):
+        res = client.ExtensionsV1beta1Deployment(metadata=client.V1ObjectMeta(namespace='ns', name='app', annotations=annotations))
+        self.worker.cache = FakeCache(res)
+        item = {'res_namespace': 'ns', 'res_name': 'app', 'event_time': event_time}
+        return self.worker.get_debounce('ns/app', 'Deployment', item)
+
+    def test_learned(self):
+        self.assertEqual(self.get_debounce({}, 1000), (10, 300))
+        self.assertEqual(self.get_debounce({}, 1040), (80, 300))
+
+    def test_fixed_debounce_is_not_learned(self):
+        fixed = {'opsguru.signature/debounce': '5', 'opsguru.signature/max-wait': '60'}
+        self.assertEqual(self.get_debounce(fixed, 1000), (5, 60))
+        self.assertEqual(self.get_debounce(fixed, 1040), (5, 60))
+        self.assertNotIn('ns/app', self.worker.debouncer.state)
+
+if __name__ == '__main__':
+    unittest.main()
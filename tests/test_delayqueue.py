@@ -0,0 +1,58 @@
+import threading, time, unittest
+from custom_libs import delayqueue
+
+class TestDelayQueue(unittest.TestCase):
+    def setUp(self):
+        self.q = delayqueue.DelayQueue("test")
+
+    def test_earliest_deadline_first(self):
+        self.q.put('a', 1, 0.2)
+        self.q.put('b', 2, 0.1)
+        self.q.put('c', 3)
+        self.assertEqual(self.q.get(), ('c', 3))
+        self.assertEqual(self.q.get(), ('b', 2))
+        self.assertEqual(self.q.get(), ('a', 1))
+        self.assertEqual(len(self.q), 0)
+
+    def test_get_waits_for_the_deadline(self):
+        start = time.time()
+        self.q.put('a', 1, 0.2)
+        self.assertEqual(self.q.get(), ('a', 1))
+        self.assertGreaterEqual(time.time(), start + 0.2)
+
+    def test_same_key_is_returned_once_with_the_newest_item(self):
+        self.q.put('a', 1)
+        self.q.put('a', 2)
+        self.assertEqual(len(self.q), 1)
+        self.assertEqual(self.q.get(), ('a', 2))
+        self.assertEqual(len(self.q), 0)
+
+    def test_earlier_deadline_wins(self):
+        start = time.time()
+        self.q.put('a', 1, 10)
+        self.q.put('a', 2, 0.1)
+        self.q.put('b', 3, 0.2)
+        self.assertEqual(self.q.get(), ('a', 2))
+        self.assertLess(time.time(), start + 0.2)
+        self.assertEqual(self.q.get(), ('b', 3))
+
+    def test_later_deadline_keeps_the_earlier_one(self):
+        self.q.put('a', 1, 0.1)
+        self.q.put('a', 2, 10)
+        start = time.time()
+        self.assertEqual(self.q.get(), ('a', 2))
+        self.assertLess(time.time(), start + 5)
+
+    def test_put_wakes_up_get(self):
+        self.q.put('a', 1, 10)
+        result = []
+        t = threading.Thread(target=lambda: result.append(self.q.get()))
+        t.daemon = True
+        t.start()
+        time.sleep(0.1)
+        self.q.put('b', 2)
+        t.join(5)
+        self.assertEqual(result, [('b', 2)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+from kubernetes import client
+from custom_libs import digests
+
+def secret(version, data=None):
+    return client.V1Secret(kind='Secret', metadata=client.V1ObjectMeta(namespace='ns', name='s', resource_version=version), data=data)
+
+class TestDigestCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = digests.DigestCache()
+        self.full = secret('5', {'a': 'x', 'b': 'y'})
+        self.reads = 0
+
+    def read(self, name, namespace):
+        self.reads += 1
+        return self.full
+
+    def test_read_once_per_version(self):
+        for keys in (None, ['a'], ['b'], ['a', 'b']):
+            self.assertEqual(self.cache.get_digest(secret('5'), keys, self.read), digests.compute_digest(self.full, keys))
+        self.assertEqual(self.reads, 1)
+
+        self.full = secret('6', {'a': 'x', 'b': 'z'})
+        self.assertEqual(self.cache.get_digest(secret('6'), ['a'], self.read), digests.compute_digest(self.full, ['a']))
+        self.assertEqual(self.reads, 2)
+
+    def test_newer_content_is_kept_for_the_event_version(self):
+        self.full = secret('7', {'a': 'x'})
+        self.cache.get_digest(secret('6'), None, self.read)
+        self.cache.get_digest(secret('6'), ['a'], self.read)
+        self.cache.get_digest(secret('7'), ['a'], self.read)
+        self.assertEqual(self.reads, 1)
+
+    def test_digest_depends_only_on_used_keys(self):
+        other = secret('6', {'a': 'x', 'b': 'changed'})
+        self.assertEqual(digests.compute_digest(self.full, ['a']), digests.compute_digest(other, ['a']))
+        self.assertNotEqual(digests.compute_digest(self.full, None), digests.compute_digest(other, None))
+
+    def test_forget(self):
+        self.cache.get_digest(secret('5'), None, self.read)
+        self.cache.forget('ns', 'Secret', 's')
+        self.cache.get_digest(secret('5'), None, self.read)
+        self.assertEqual(self.reads, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+from custom_libs import ratelimit
+
+class TestTokenBucket(unittest.TestCase):
+    def test_no_limit(self):
+        bucket = ratelimit.TokenBucket("test", 0)
+        for i in range(100):
+            self.assertEqual(bucket.try_acquire(), 0)
+
+    def test_burst(self):
+        bucket = ratelimit.TokenBucket("test", 1, 3)
+        for i in range(3):
+            self.assertEqual(bucket.try_acquire(), 0)
+        wait = bucket.try_acquire()
+        self.assertGreater(wait, 0.9)
+        self.assertLessEqual(wait, 1)
+
+    def test_refill(self):
+        bucket = ratelimit.TokenBucket("test", 10, 2)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertGreater(bucket.try_acquire(), 0)
+        bucket.last -= 0.1
+        self.assertEqual(bucket.try_acquire(), 0)
+
+    def test_refill_stops_at_burst(self):
+        bucket = ratelimit.TokenBucket("test", 10, 2)
+        bucket.last -= 3600
+        for i in range(2):
+            self.assertEqual(bucket.try_acquire(), 0)
+        self.assertGreater(bucket.try_acquire(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+import time, unittest
+from kubernetes import client
+from custom_libs import restarter
+
+CHANGES = {'opsguru.signature/ConfigMap.cm-0': 'v2'}
+
+class FakeCache():
+    def __init__(self, res, kind):
+        self.res = res
+        self.kind = kind
+
+    def get(self, namespace, name, kind):
+        if kind == self.kind and self.res is not None and self.res.metadata.name == name:
+            return self.res
+        return None
+
+class FakePodCache():
+    def __init__(self, pods):
+        self.pods = pods
+
+    def get_pods_for_controller(self, namespace, name, kind):
+        return list(self.pods)
+
+class FakeCoreV1Api():
+    def __init__(self):
+        self.deleted = []
+
+    def delete_namespaced_pod(self, name, namespace, body):
+        self.deleted.append(name)
+
+def pod(name, uid, updated=False, ready=True):
+    annotations = dict(CHANGES) if updated else {}
+    condition = client.V1PodCondition(type='Ready', status='True' if ready else 'False')
+    return client.V1Pod(metadata=client.V1ObjectMeta(namespace='ns', name=name, uid=uid, annotations=annotations),
+                        status=client.V1PodStatus(phase='Running', conditions=[condition]))
+
+def replication_controller(replicas, annotations=None):
+    return client.V1ReplicationController(metadata=client.V1ObjectMeta(namespace='ns', name='rc', annotations=annotations),
+                                          spec=client.V1ReplicationControllerSpec(replicas=replicas))
+
+def stateful_set(replicas, strategy='OnDelete', policy=None, annotations=None):
+    spec = client.V1beta1StatefulSetSpec(replicas=replicas, service_name='web', pod_management_policy=policy,
+                                         template=client.V1PodTemplateSpec(),
+                                         update_strategy=client.V1beta1StatefulSetUpdateStrategy(type=strategy))
+    return client.V1beta1StatefulSet(metadata=client.V1ObjectMeta(namespace='ns', name='web', annotations=annotations), spec=spec)
+
+class TestRestarter(unittest.TestCase):
+    def make_restarter(self, res, kind, pods, max_unavailable='25%'):
+        self.pods = pods
+        self.restarter = restarter.threadRestarter("test", FakeCache(res, kind), FakePodCache(pods), max_unavailable)
+        self.restarter.v1 = FakeCoreV1Api()
+        self.restarter.restart('ns', res.metadata.name, kind, CHANGES)
+        self.key = ('ns', kind, res.metadata.name)
+        return self.restarter
+
+    def restart_batch(self):
+        return self.restarter.restart_batch(self.key, self.restarter.jobs[self.key])
+
+    def replace(self, name, ready):
+        """
+        The controller replaced a deleted pod with a new one
+        """
+        self.pods[:] = [p for p in self.pods if p.metadata.name != name]
+        self.pods.append(pod(name, name + '-new', updated=True, ready=ready))
+
+    def test_max_unavailable_percentage(self):
+        pods = [pod('rc-%s' % i, str(i)) for i in range(8)]
+        self.make_restarter(replication_controller(8), 'ReplicationController', pods, '25%')
+        self.assertFalse(self.restart_batch())
+        self.assertEqual(len(self.restarter.v1.deleted), 2)
+
+    def test_max_unavailable_percentage_is_at_least_one(self):
+        pods = [pod('rc-%s' % i, str(i)) for i in range(3)]
+        self.make_restarter(replication_controller(3), 'ReplicationController', pods, '10%')
+        self.restart_batch()
+        self.assertEqual(len(self.restarter.v1.deleted), 1)
+
+    def test_max_unavailable_number(self):
+        pods = [pod('rc-%s' % i, str(i)) for i in range(8)]
+        self.make_restarter(replication_controller(8), 'ReplicationController', pods, 3)
+        self.restart_batch()
+        self.assertEqual(len(self.restarter.v1.deleted), 3)
+
+    def test_max_unavailable_annotation(self):
+        pods = [pod('rc-%s' % i, str(i)) for i in range(8)]
+        res = replication_controller(8, {'opsguru.signature/max-unavailable': '50%'})
+        self.make_restarter(res, 'ReplicationController', pods, 1)
+        self.restart_batch()
+        self.assertEqual(len(self.restarter.v1.deleted), 4)
+
+    def test_invalid_max_unavailable(self):
+        pods = [pod('rc-%s' % i, str(i)) for i in range(8)]
+        res = replication_controller(8, {'opsguru.signature/max-unavailable': 'many'})
+        self.make_restarter(res, 'ReplicationController', pods)
+        self.restart_batch()
+        self.assertEqual(len(self.restarter.v1.deleted), 1)
+
+    def test_waits_for_replacements_to_be_ready(self):
+        pods = [pod('rc-%s' % i, str(i)) for i in range(4)]
+        self.make_restarter(replication_controller(4), 'ReplicationController', pods, 1)
+        self.assertFalse(self.restart_batch())
+        self.assertEqual(self.restarter.v1.deleted, ['rc-0'])
+
+        # not replaced yet, the pod cache still has the deleted pod
+        self.assertFalse(self.restart_batch())
+        self.replace('rc-0', ready=False)
+        self.assertFalse(self.restart_batch())
+        self.assertEqual(self.restarter.v1.deleted, ['rc-0'])
+
+        self.replace('rc-0', ready=True)
+        self.assertFalse(self.restart_batch())
+        self.assertEqual(self.restarter.v1.deleted, ['rc-0', 'rc-1'])
+
+    def test_done_when_all_pods_are_new_and_ready(self):
+        pods = [pod('rc-0', '0')]
+        self.make_restarter(replication_controller(1), 'ReplicationController', pods)
+        self.assertFalse(self.restart_batch())
+        self.replace('rc-0', ready=False)
+        self.assertFalse(self.restart_batch())
+        self.replace('rc-0', ready=True)
+        self.assertTrue(self.restart_batch())
+
+    def test_gives_up_without_progress(self):
+        pods = [pod('rc-0', '0', ready=False), pod('rc-1', '1')]
+        self.make_restarter(replication_controller(2), 'ReplicationController', pods, 1)
+        self.assertFalse(self.restart_batch())
+        self.restarter.jobs[self.key]['progress'] = time.time() - self.restarter.progress_timeout - 1
+        self.assertTrue(self.restart_batch())
+        self.assertEqual(self.restarter.v1.deleted, [])
+
+    def test_stateful_set_highest_ordinal_first(self):
+        pods = [pod('web-%s' % i, str(i)) for i in range(4)]
+        self.make_restarter(stateful_set(4, policy='Parallel'), 'StatefulSet', pods, 2)
+        self.restart_batch()
+        self.assertEqual(self.restarter.v1.deleted, ['web-3', 'web-2'])
+
+    def test_stateful_set_ordered_ready_one_at_a_time(self):
+        pods = [pod('web-%s' % i, str(i)) for i in range(4)]
+        self.make_restarter(stateful_set(4), 'StatefulSet', pods, '100%')
+        self.restart_batch()
+        self.assertEqual(self.restarter.v1.deleted, ['web-3'])
+        self.replace('web-3', ready=True)
+        self.restart_batch()
+        self.assertEqual(self.restarter.v1.deleted, ['web-3', 'web-2'])
+
+    def test_stateful_set_partition(self):
+        pods = [pod('web-%s' % i, str(i)) for i in range(4)]
+        res = stateful_set(4, policy='Parallel', annotations={'opsguru.signature/partition': '2'})
+        self.make_restarter(res, 'StatefulSet', pods, '100%')
+        self.assertFalse(self.restart_batch())
+        self.assertEqual(self.restarter.v1.deleted, ['web-3', 'web-2'])
+        self.replace('web-3', ready=True)
+        self.replace('web-2', ready=True)
+        self.assertTrue(self.restart_batch())
+        self.assertEqual(self.restarter.v1.deleted, ['web-3', 'web-2'])
+
+    def test_rolling_update_stateful_set_is_skipped(self):
+        pods = [pod('web-%s' % i, str(i)) for i in range(4)]
+        self.make_restarter(stateful_set(4, strategy='RollingUpdate'), 'StatefulSet', pods)
+        self.assertTrue(self.restart_batch())
+        self.assertEqual(self.restarter.v1.deleted, [])
+
+    def test_deleted_controller(self):
+        self.make_restarter(replication_controller(1), 'ReplicationController', [pod('rc-0', '0')])
+        self.restarter.cache.res = None
+        self.assertTrue(self.restart_batch())
+
+class TestOrdinal(unittest.TestCase):
+    def test_get_ordinal(self):
+        self.assertEqual(restarter.get_ordinal(pod('web-12', '0')), 12)
+        self.assertEqual(restarter.get_ordinal(pod('web', '0')), -1)
+        self.assertEqual(restarter.get_ordinal(pod('rc-x1b2c', '0')), -1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+import time, unittest
+from kubernetes import client
+from custom_libs import rolloutbudget
+
+class FakeCache():
+    def __init__(self):
+        self.resources = {}
+
+    def add(self, kind, res):
+        self.resources[(res.metadata.namespace, res.metadata.name, kind)] = res
+
+    def get(self, namespace, name, kind):
+        return self.resources.get((namespace, name, kind))
+
+class FakeRestarter():
+    def __init__(self):
+        self.restarting = set()
+
+    def is_restarting(self, namespace, name, kind):
+        return (namespace, kind, name) in self.restarting
+
+def metadata(namespace, name, generation=1, annotations=None):
+    return client.V1ObjectMeta(namespace=namespace, name=name, generation=generation, annotations=annotations)
+
+def deployment(namespace, name, generation=1, paused=None):
+    spec = client.ExtensionsV1beta1DeploymentSpec(replicas=2, paused=paused, template=client.V1PodTemplateSpec())
+    status = client.ExtensionsV1beta1DeploymentStatus(observed_generation=generation, replicas=2, updated_replicas=2, available_replicas=2)
+    return client.ExtensionsV1beta1Deployment(metadata=metadata(namespace, name, generation), spec=spec, status=status)
+
+def daemon_set(namespace, name, strategy=None):
+    update_strategy = client.V1beta1DaemonSetUpdateStrategy(type=strategy) if strategy else None
+    spec = client.V1beta1DaemonSetSpec(template=client.V1PodTemplateSpec(), update_strategy=update_strategy)
+    status = client.V1beta1DaemonSetStatus(observed_generation=1, current_number_scheduled=3, desired_number_scheduled=3,
+                                           number_misscheduled=0, number_ready=3, updated_number_scheduled=3, number_available=3)
+    return client.V1beta1DaemonSet(metadata=metadata(namespace, name), spec=spec, status=status)
+
+def stateful_set(namespace, name, strategy='RollingUpdate', partition=None, annotations=None):
+    rolling_update = client.V1beta1RollingUpdateStatefulSetStrategy(partition=partition) if partition is not None else None
+    spec = client.V1beta1StatefulSetSpec(replicas=3, service_name='web', template=client.V1PodTemplateSpec(),
+                                         update_strategy=client.V1beta1StatefulSetUpdateStrategy(type=strategy, rolling_update=rolling_update))
+    status = client.V1beta1StatefulSetStatus(observed_generation=1, replicas=3, ready_replicas=3, updated_replicas=3)
+    return client.V1beta1StatefulSet(metadata=metadata(namespace, name, annotations=annotations), spec=spec, status=status)
+
+def rolled(res, updated=None):
+    """
+    The controller saw the patch, updated pods as given
+    """
+    res.metadata.generation += 1
+    res.status.observed_generation = res.metadata.generation
+    if updated is not None:
+        res.status.updated_replicas = updated
+
+class TestRolloutBudget(unittest.TestCase):
+    def setUp(self):
+        self.cache = FakeCache()
+        self.restarter = FakeRestarter()
+
+    def budget(self, max_rollouts=0, max_rollouts_per_namespace=0, progress_timeout=600):
+        return rolloutbudget.RolloutBudget(self.cache, max_rollouts, max_rollouts_per_namespace, self.restarter, progress_timeout)
+
+    def test_no_limit(self):
+        budget = self.budget()
+        for i in range(10):
+            self.assertTrue(budget.acquire('ns', 'app-%s' % i, 'Deployment'))
+        self.assertEqual(budget.in_progress, {})
+
+    def test_global_limit_until_rolled_out(self):
+        for name in ('app-0', 'app-1'):
+            self.cache.add('Deployment', deployment('ns', name))
+        budget = self.budget(max_rollouts=1)
+        self.assertTrue(budget.acquire('ns', 'app-0', 'Deployment'))
+        self.assertFalse(budget.acquire('ns', 'app-1', 'Deployment'))
+
+        res = self.cache.get('ns', 'app-0', 'Deployment')
+        rolled(res, updated=1)
+        self.assertFalse(budget.acquire('ns', 'app-1', 'Deployment'))
+        res.status.updated_replicas = 2
+        self.assertTrue(budget.acquire('ns', 'app-1', 'Deployment'))
+
+    def test_namespace_limit(self):
+        for (namespace, name) in (('a', 'app-0'), ('a', 'app-1'), ('b', 'app-0')):
+            self.cache.add('Deployment', deployment(namespace, name))
+        budget = self.budget(max_rollouts_per_namespace=1)
+        self.assertTrue(budget.acquire('a', 'app-0', 'Deployment'))
+        self.assertFalse(budget.acquire('a', 'app-1', 'Deployment'))
+        self.assertTrue(budget.acquire('b', 'app-0', 'Deployment'))
+
+    def test_release(self):
+        for name in ('app-0', 'app-1'):
+            self.cache.add('Deployment', deployment('ns', name))
+        budget = self.budget(max_rollouts=1)
+        self.assertTrue(budget.acquire('ns', 'app-0', 'Deployment'))
+        budget.release('ns', 'app-0', 'Deployment')
+        self.assertTrue(budget.acquire('ns', 'app-1', 'Deployment'))
+
+    def test_deleted_controller(self):
+        self.cache.add('Deployment', deployment('ns', 'app-0'))
+        budget = self.budget(max_rollouts=1)
+        self.assertTrue(budget.acquire('ns', 'app-0', 'Deployment'))
+        del self.cache.resources[('ns', 'app-0', 'Deployment')]
+        self.assertTrue(budget.acquire('ns', 'app-1', 'Deployment'))
+
+    def test_on_delete_daemon_set_never_counts(self):
+        self.cache.add('DaemonSet', daemon_set('ns', 'ds-0'))
+        self.cache.add('DaemonSet', daemon_set('ns', 'ds-1', 'RollingUpdate'))
+        self.cache.add('DaemonSet', daemon_set('ns', 'ds-2', 'RollingUpdate'))
+        budget = self.budget(max_rollouts=1)
+        self.assertTrue(budget.acquire('ns', 'ds-0', 'DaemonSet'))
+        self.assertTrue(budget.acquire('ns', 'ds-1', 'DaemonSet'))
+        self.assertFalse(budget.acquire('ns', 'ds-2', 'DaemonSet'))
+
+    def test_paused_deployment(self):
+        self.cache.add('Deployment', deployment('ns', 'app-0', paused=True))
+        self.cache.add('Deployment', deployment('ns', 'app-1'))
+        self.cache.add('Deployment', deployment('ns', 'app-2'))
+        budget = self.budget(max_rollouts=1)
+        self.assertTrue(budget.acquire('ns', 'app-0', 'Deployment'))
+        self.assertTrue(budget.acquire('ns', 'app-1', 'Deployment'))
+        # paused after the patch, it won't roll
+        self.cache.get('ns', 'app-1', 'Deployment').spec.paused = True
+        self.assertTrue(budget.acquire('ns', 'app-2', 'Deployment'))
+
+    def test_stuck_rollout_times_out(self):
+        self.cache.add('Deployment', deployment('ns', 'app-0'))
+        self.cache.add('Deployment', deployment('ns', 'app-1'))
+        budget = self.budget(max_rollouts=1, progress_timeout=60)
+        self.assertTrue(budget.acquire('ns', 'app-0', 'Deployment'))
+        self.assertFalse(budget.acquire('ns', 'app-1', 'Deployment'))
+        (generation, start) = budget.in_progress[('ns', 'Deployment', 'app-0')]
+        budget.in_progress[('ns', 'Deployment', 'app-0')] = (generation, start - 61)
+        self.assertTrue(budget.acquire('ns', 'app-1', 'Deployment'))
+
+    def test_stateful_set_waits_for_updated_replicas(self):
+        self.cache.add('StatefulSet', stateful_set('ns', 'web-0'))
+        self.cache.add('StatefulSet', stateful_set('ns', 'web-1'))
+        budget = self.budget(max_rollouts=1)
+        self.assertTrue(budget.acquire('ns', 'web-0', 'StatefulSet'))
+        res = self.cache.get('ns', 'web-0', 'StatefulSet')
+        rolled(res, updated=0)
+        self.assertFalse(budget.acquire('ns', 'web-1', 'StatefulSet'))
+        res.status.updated_replicas = 3
+        self.assertTrue(budget.acquire('ns', 'web-1', 'StatefulSet'))
+
+    def test_stateful_set_partition(self):
+        self.cache.add('StatefulSet', stateful_set('ns', 'web-0', partition=2))
+        self.cache.add('StatefulSet', stateful_set('ns', 'web-1', 'OnDelete', annotations={'opsguru.signature/partition': '1'}))
+        self.cache.add('StatefulSet', stateful_set('ns', 'web-2'))
+        budget = self.budget(max_rollouts=1)
+        self.assertTrue(budget.acquire('ns', 'web-0', 'StatefulSet'))
+        rolled(self.cache.get('ns', 'web-0', 'StatefulSet'), updated=1)
+        self.assertTrue(budget.acquire('ns', 'web-1', 'StatefulSet'))
+        rolled(self.cache.get('ns', 'web-1', 'StatefulSet'), updated=2)
+        self.assertTrue(budget.acquire('ns', 'web-2', 'StatefulSet'))
+
+    def test_restarting_controller_counts(self):
+        self.cache.add('ReplicationController', client.V1ReplicationController(
+            metadata=metadata('ns', 'rc-0'), spec=client.V1ReplicationControllerSpec(replicas=1),
+            status=client.V1ReplicationControllerStatus(observed_generation=1, replicas=1, ready_replicas=1)))
+        budget = self.budget(max_rollouts=1)
+        self.assertTrue(budget.acquire('ns', 'rc-0', 'ReplicationController'))
+        rolled(self.cache.get('ns', 'rc-0', 'ReplicationController'))
+        self.restarter.restarting.add(('ns', 'ReplicationController', 'rc-0'))
+        self.assertFalse(budget.acquire('ns', 'rc-1', 'ReplicationController'))
+        self.restarter.restarting.clear()
+        self.assertTrue(budget.acquire('ns', 'rc-1', 'ReplicationController'))
+
+if __name__ == '__main__':
+    unittest.main()
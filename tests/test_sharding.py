@@ -0,0 +1,241 @@
+import threading, time, unittest, Queue
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from custom_libs import sharding, watchchanges
+
+class TestHashRing(unittest.TestCase):
+    def test_empty_ring(self):
+        self.assertIsNone(sharding.HashRing([]).get_owner('ns-0'))
+
+    def test_single_member_owns_everything(self):
+        ring = sharding.HashRing(['a'])
+        self.assertEqual(set(ring.get_owner('ns-%s' % i) for i in range(100)), set(['a']))
+
+    def test_owner_does_not_depend_on_member_order(self):
+        ring1 = sharding.HashRing(['a', 'b', 'c'])
+        ring2 = sharding.HashRing(['c', 'a', 'b'])
+        for i in range(100):
+            self.assertEqual(ring1.get_owner('ns-%s' % i), ring2.get_owner('ns-%s' % i))
+
+    def test_keys_are_spread(self):
+        ring = sharding.HashRing(['a', 'b', 'c'])
+        owners = [ring.get_owner('ns-%s' % i) for i in range(300)]
+        for member in ('a', 'b', 'c'):
+            self.assertGreater(owners.count(member), 50)
+
+    def test_new_member_only_takes_keys(self):
+        before = sharding.HashRing(['a', 'b'])
+        after = sharding.HashRing(['a', 'b', 'c'])
+        moved = 0
+        for i in range(300):
+            key = 'ns-%s' % i
+            if before.get_owner(key) != after.get_owner(key):
+                self.assertEqual(after.get_owner(key), 'c')
+                moved += 1
+        self.assertGreater(moved, 0)
+        self.assertLess(moved, 200)
+
+class TestMemoryBackend(unittest.TestCase):
+    def test_heartbeat_and_leave(self):
+        backend = sharding.MemoryBackend()
+        backend.heartbeat('a', 30)
+        backend.heartbeat('b', 30)
+        self.assertEqual(sorted(backend.get_members()), ['a', 'b'])
+        backend.leave('a')
+        self.assertEqual(backend.get_members(), ['b'])
+        backend.leave('a')
+        self.assertEqual(backend.get_members(), ['b'])
+
+    def test_expired_members_are_gone(self):
+        backend = sharding.MemoryBackend()
+        backend.heartbeat('a', 30)
+        backend.heartbeat('b', -1)
+        self.assertEqual(backend.get_members(), ['a'])
+
+class TestShardManager(unittest.TestCase):
+    def setUp(self):
+        self.managers = []
+
+    def tearDown(self):
+        # the threads can't be stopped, keep them asleep until the end of the tests
+        for shards in self.managers:
+            shards.interval = 3600
+        time.sleep(0.05)
+
+    def start(self, backend, identity):
+        shards = sharding.threadShardManager(identity, backend, identity, ttl=30, interval=0.01)
+        shards.daemon = True
+        shards.start()
+        self.managers.append(shards)
+        self.assertTrue(shards.ready.wait(5))
+        return shards
+
+    def wait_for_members(self, shards, members):
+        deadline = time.time() + 5
+        while shards.members != members and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(shards.members, members)
+
+    def test_namespaces_are_split(self):
+        backend = sharding.MemoryBackend()
+        shards_a = self.start(backend, 'a')
+        shards_b = self.start(backend, 'b')
+        self.wait_for_members(shards_a, ['a', 'b'])
+        self.wait_for_members(shards_b, ['a', 'b'])
+        for i in range(100):
+            self.assertNotEqual(shards_a.owns('ns-%s' % i), shards_b.owns('ns-%s' % i))
+
+    def test_rebalance_calls_callbacks(self):
+        backend = sharding.MemoryBackend()
+        shards = self.start(backend, 'a')
+        rebalanced = threading.Event()
+        shards.on_rebalance(rebalanced.set)
+        backend.heartbeat('b', 30)
+        self.assertTrue(rebalanced.wait(5))
+        self.wait_for_members(shards, ['a', 'b'])
+
+class FakeShards():
+    def __init__(self, owned=('ns-0',)):
+        self.callbacks = []
+        self.owned = frozenset(owned)
+
+    def on_rebalance(self, callback):
+        self.callbacks.append(callback)
+
+    def rebalance(self, owned):
+        self.owned = frozenset(owned)
+        for callback in self.callbacks:
+            callback()
+
+    def get_ring(self):
+        return self.owned
+
+    def owns(self, namespace, ring=None):
+        return namespace in (self.owned if ring is None else ring)
+
+class FakeWatch():
+    def __init__(self, events, block=False):
+        self.events = events
+        self.block = block
+        self.stopped = False
+
+    def stream(self, func, *args, **kwargs):
+        for event in self.events:
+            if self.stopped:
+                return
+            yield event
+        if self.block:
+            # a watch without events that never ends
+            threading.Event().wait()
+
+    def stop(self):
+        self.stopped = True
+
+class FakeWorkloadCache():
+    def __init__(self):
+        self.synced = threading.Event()
+        self.synced.set()
+        self.users = {}
+
+    def wait_for_sync(self, timeout=None):
+        return self.synced.wait(timeout)
+
+    def get_resources_using(self, namespace, cfg_kind, cfg_name):
+        return self.users.get((namespace, cfg_kind, cfg_name), [])
+
+def config_map(namespace, name, version):
+    return client.V1ConfigMap(metadata=client.V1ObjectMeta(namespace=namespace, name=name, resource_version=version))
+
+def deployment(namespace, name):
+    annotations = {'opsguru.signature/should_update': 'True'}
+    template = client.V1PodTemplateSpec(metadata=client.V1ObjectMeta(annotations={}))
+    return client.ExtensionsV1beta1Deployment(metadata=client.V1ObjectMeta(namespace=namespace, name=name, annotations=annotations),
+                                              spec=client.ExtensionsV1beta1DeploymentSpec(template=template))
+
+class TestRebalance(unittest.TestCase):
+    def setUp(self):
+        self.items = [config_map('ns-0', 'cm-0', '1')]
+        self.shards = FakeShards()
+        self.cache = FakeWorkloadCache()
+        self.q = Queue.Queue()
+        self.watcher = watchchanges.threadWatchChanges("configmaps", self.q, self.list_config_maps, 'ConfigMap',
+                                                       self.cache, 0, shards=self.shards)
+
+    def list_config_maps(self, **kwargs):
+        return client.V1ConfigMapList(metadata=client.V1ListMeta(resource_version='10'), items=self.items)
+
+    def test_resync_clears_synced_until_relisted(self):
+        self.watcher.relist()
+        self.assertTrue(self.watcher.synced.is_set())
+        self.watcher.resync()
+        self.assertFalse(self.watcher.synced.is_set())
+        self.watcher.resync_requested = False
+        self.watcher.relist()
+        self.assertTrue(self.watcher.synced.is_set())
+
+    def test_relist_waits_for_workload_cache(self):
+        # the cache clears its synced event on the same rebalance, before the watchers
+        self.cache.synced.clear()
+        t = threading.Thread(target=self.watcher.relist)
+        t.daemon = True
+        t.start()
+        t.join(0.2)
+        self.assertTrue(t.is_alive())
+        self.assertTrue(self.q.empty())
+
+        self.cache.users[('ns-0', 'ConfigMap', 'cm-0')] = [(deployment('ns-0', 'app-0'), 'Deployment', None)]
+        self.cache.synced.set()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        item = self.q.get_nowait()
+        self.assertEqual((item['res_namespace'], item['res_name'], item['cfg_name'], item['cfg_version']),
+                         ('ns-0', 'app-0', 'cm-0', '1'))
+
+    def test_watch_ignores_new_namespaces_until_listed(self):
+        self.items.append(config_map('ns-1', 'cm-1', '1'))
+        self.watcher.relist()
+        self.assertEqual(self.watcher.versions, {'ns-0/cm-0': '1'})
+
+        # the ring changed, the resync is not requested yet and the cache doesn't have ns-1
+        self.shards.owned = frozenset(['ns-0', 'ns-1'])
+        self.items[1] = config_map('ns-1', 'cm-1', '2')
+        self.watcher.w = FakeWatch([{'type': 'MODIFIED', 'object': self.items[1]}])
+        self.watcher.watch()
+        self.assertNotIn('ns-1/cm-1', self.watcher.versions)
+        self.assertEqual(self.watcher.resource_version, '2')
+
+        self.cache.users[('ns-1', 'ConfigMap', 'cm-1')] = [(deployment('ns-1', 'app-1'), 'Deployment', None)]
+        self.shards.rebalance(['ns-0', 'ns-1'])
+        self.watcher.resync_requested = False
+        self.watcher.relist()
+        item = self.q.get_nowait()
+        self.assertEqual((item['res_namespace'], item['cfg_name'], item['cfg_version']), ('ns-1', 'cm-1', '2'))
+
+    def test_watch_stops_before_applying_when_resync_requested(self):
+        self.watcher.relist()
+        self.watcher.resync()
+        self.watcher.w = FakeWatch([{'type': 'MODIFIED', 'object': config_map('ns-0', 'cm-0', '2')}])
+        self.watcher.watch()
+        self.assertTrue(self.watcher.w.stopped)
+        self.assertEqual(self.watcher.versions, {'ns-0/cm-0': '1'})
+
+    def test_failed_resync_lists_again(self):
+        self.watcher.relist()
+        self.watcher.resync()
+        calls = []
+
+        def list_config_maps(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                raise ApiException(status=500)
+            return self.list_config_maps(**kwargs)
+
+        self.watcher.list_func = list_config_maps
+        self.watcher.w = FakeWatch([], block=True)
+        self.watcher.daemon = True
+        self.watcher.start()
+        self.assertTrue(self.watcher.synced.wait(5))
+        self.assertEqual(len(calls), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import threading, time, unittest, Queue
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from custom_libs import digests, watchchanges
+
+class FakeWorkloadCache():
+    def __init__(self, users):
+        self.users = users
+
+    def wait_for_sync(self, timeout=None):
+        return True
+
+    def get_resources_using(self, namespace, cfg_kind, cfg_name):
+        return self.users.get((namespace, cfg_kind, cfg_name), [])
+
+def config_map(version, data=None):
+    return client.V1ConfigMap(kind='ConfigMap', data=data,
+                              metadata=client.V1ObjectMeta(namespace='ns', name='cm', resource_version=version))
+
+def deployment(name):
+    annotations = {'opsguru.signature/should_update': 'True'}
+    template = client.V1PodTemplateSpec(metadata=client.V1ObjectMeta(annotations={}))
+    return client.ExtensionsV1beta1Deployment(metadata=client.V1ObjectMeta(namespace='ns', name=name, annotations=annotations),
+                                              spec=client.ExtensionsV1beta1DeploymentSpec(template=template))
+
+class TestContentReads(unittest.TestCase):
+    def setUp(self):
+        self.q = Queue.Queue()
+        self.errors = []
+        self.full = config_map('2', {'a': 'x'})
+        cache = FakeWorkloadCache({('ns', 'ConfigMap', 'cm'): [(deployment('app'), 'Deployment', None)]})
+        self.watcher = watchchanges.threadWatchChanges("configmaps", self.q, None, 'ConfigMap', cache, 0,
+                                                       digests=digests.DigestCache(), read_func=self.read,
+                                                       retry_delay=0.01)
+
+    def read(self, name, namespace):
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.full
+
+    def test_failed_read_is_retried(self):
+        self.errors = [ApiException(status=500), ApiException(status=503)]
+        self.watcher.apply('MODIFIED', config_map('2'))
+        self.assertTrue(self.q.empty())
+        self.assertEqual(self.watcher.get_checkpoint()['versions'], {})
+
+        item = self.q.get(timeout=5)
+        self.assertEqual(item['cfg_version'], digests.compute_digest(self.full))
+        self.assertEqual(self.watcher.outstanding, {})
+        self.assertEqual(self.watcher.failures, {})
+
+    def test_retry_skipped_for_newer_version(self):
+        self.errors = [ApiException(status=500)]
+        self.watcher.retry_delay = 0.2
+        self.watcher.apply('MODIFIED', config_map('2'))
+        self.full = config_map('3', {'a': 'y'})
+        self.watcher.apply('MODIFIED', config_map('3'))
+        self.assertEqual(self.q.get(timeout=5)['cfg_version'], digests.compute_digest(self.full))
+        time.sleep(0.4)
+        self.assertTrue(self.q.empty())
+
+    def test_deleted_config_is_not_retried(self):
+        self.errors = [ApiException(status=404)]
+        self.watcher.apply('MODIFIED', config_map('2'))
+        self.assertEqual(self.watcher.outstanding, {})
+        self.assertEqual(self.watcher.failures, {})
+
+if __name__ == '__main__':
+    unittest.main()